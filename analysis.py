@@ -0,0 +1,56 @@
+import struct
+
+import numpy as np
+
+
+MAGIC = b'PZA1'
+RECORD_HEADER = struct.Struct('<IH')
+PLY_HEADER = struct.Struct('<HB')
+
+
+class AnalysisWriter():
+    """
+    Writes the engine analyses of EPD lines to a compact binary file, so that puzzles can be rescored without an engine.
+    A record consists of the EPD line followed by its analyzed plies. Per ply, the mate flags and scores of the two best lines
+    of each depth are stored, whether the best line of each depth starts with the final best move,
+    and the first two moves of the final best line.
+    """
+
+    def __init__(self, path, append=False):
+        self.file = open(path, 'ab' if append else 'wb')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def close(self):
+        self.file.close()
+
+    def write(self, epd, plies):
+        epd = epd.encode()
+        chunks = [RECORD_HEADER.pack(len(epd), len(plies)), epd]
+        for mates, scores, is_bestmove, pv in plies:
+            pv = ' '.join(pv).encode()
+            chunks += [PLY_HEADER.pack(len(is_bestmove), len(pv)), pv,
+                       mates.astype(np.uint8).tobytes(), scores.astype('<i4').tobytes(), is_bestmove.astype(np.uint8).tobytes()]
+        self.file.write(b''.join(chunks))
+
+
+def read_analyses(path):
+    """Yield the EPD line and the list of (mates, scores, is_bestmove, pv) plies of each record of an analysis file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('{} is not an analysis file'.format(path))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            size, count = RECORD_HEADER.unpack(header)
+            epd = f.read(size).decode()
+            plies = []
+            for _ in range(count):
+                depths, pv_size = PLY_HEADER.unpack(f.read(PLY_HEADER.size))
+                pv = f.read(pv_size).decode().split()
+                mates = np.frombuffer(f.read(2 * depths), dtype=np.uint8).astype(bool).reshape(-1, 2)
+                scores = np.frombuffer(f.read(8 * depths), dtype='<i4').astype(float).reshape(-1, 2)
+                is_bestmove = np.frombuffer(f.read(depths), dtype=np.uint8).astype(bool)
+                plies.append((mates, scores, is_bestmove, pv))
+            yield epd, plies
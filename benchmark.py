@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MOCK_ENGINE = os.path.join(ROOT, 'mock_engine.py')
+STAGES = ('generator', 'puzzler', 'filter', 'deduplicate', 'pgn', 'kif')
+
+
+def line_count(path):
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def run_stage(script, arguments, output_path, engine_log=None):
+    """Run a script with its output written to a file and return the wall time and the time spent in mock engine searches."""
+    env = dict(os.environ)
+    if engine_log:
+        env['MOCK_ENGINE_LOG'] = engine_log
+        open(engine_log, 'w').close()
+    start = time.perf_counter()
+    with open(output_path, 'w') as output:
+        subprocess.run([sys.executable, os.path.join(ROOT, script)] + arguments, stdout=output, stderr=subprocess.DEVNULL, env=env, check=True)
+    seconds = time.perf_counter() - start
+    engine_seconds = 0
+    if engine_log:
+        with open(engine_log) as f:
+            engine_seconds = sum(float(line) for line in f if line.strip())
+    return seconds, engine_seconds
+
+
+def result(items, seconds, engine_seconds=0):
+    return {'items': items, 'seconds': round(seconds, 4), 'engine_seconds': round(engine_seconds, 4),
+            'items_per_second': round(items / seconds, 2) if seconds else 0}
+
+
+def generate_corpus(workdir, name, variant, count, depth, latency):
+    """Generate positions and puzzles for a variant using the mock engine, and return the timings of both steps."""
+    log = os.path.join(workdir, 'engine.log')
+    positions_path = os.path.join(workdir, name + '.fen')
+    puzzles_path = os.path.join(workdir, name + '.epd')
+    options = ['-o', 'Latency={}'.format(latency), '-o', 'WinRate=50']
+    seconds, engine_seconds = run_stage('generator.py', ['-e', MOCK_ENGINE, '-v', variant, '-c', str(count), '-d', '2'] + options, positions_path, log)
+    generator = result(line_count(positions_path), seconds, engine_seconds)
+    seconds, engine_seconds = run_stage('puzzler.py', ['-e', MOCK_ENGINE, '-d', str(depth), positions_path] + options, puzzles_path, log)
+    puzzler = result(generator['items'], seconds, engine_seconds)
+    return positions_path, puzzles_path, generator, puzzler
+
+
+def run_benchmarks(workdir, stages, count, depth, latency, variant, shogi_variant):
+    results = {}
+    positions_path, puzzles_path, results['generator'], results['puzzler'] = generate_corpus(workdir, 'corpus', variant, count, depth, latency)
+    puzzles = line_count(puzzles_path)
+    output_path = os.path.join(workdir, 'output')
+    if 'filter' in stages:
+        results['filter'] = result(puzzles, *run_stage('filter.py', [puzzles_path, '-n', 'pv=1', '-x', 'finalmaterial=1000'], output_path))
+    if 'deduplicate' in stages:
+        results['deduplicate'] = result(puzzles, *run_stage('deduplicate.py', [puzzles_path], output_path))
+    if 'pgn' in stages:
+        results['pgn'] = result(puzzles, *run_stage('pgn.py', [puzzles_path], output_path))
+    if 'kif' in stages:
+        _, shogi_puzzles_path, _, _ = generate_corpus(workdir, 'shogi', shogi_variant, count, depth, latency)
+        results['kif'] = result(line_count(shogi_puzzles_path), *run_stage('kif.py', [shogi_puzzles_path], output_path))
+    return {stage: results[stage] for stage in STAGES if stage in stages}
+
+
+def compare(results, baseline, tolerance):
+    """Return the stages whose throughput dropped by more than the tolerance compared to the baseline."""
+    regressions = []
+    for stage, values in results.items():
+        reference = baseline['stages'].get(stage)
+        if reference and values['items_per_second'] < reference['items_per_second'] * (1 - tolerance):
+            regressions.append(stage)
+    return regressions
+
+
+def print_results(results, baseline=None, stream=sys.stdout):
+    stream.write('{:<12} {:>8} {:>10} {:>10} {:>12} {:>10}{}\n'.format(
+        'stage', 'items', 'seconds', 'engine', 'overhead/ms', 'items/s', '  baseline' if baseline else ''))
+    for stage, values in results.items():
+        overhead = 1000 * (values['seconds'] - values['engine_seconds']) / values['items'] if values['items'] else 0
+        reference = baseline['stages'].get(stage, {}).get('items_per_second', '-') if baseline else None
+        stream.write('{:<12} {:>8} {:>10.3f} {:>10.3f} {:>12.3f} {:>10.1f}{}\n'.format(
+            stage, values['items'], values['seconds'], values['engine_seconds'], overhead, values['items_per_second'],
+            '  {:>8}'.format(reference) if baseline else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput of the scripts on synthetic input using the mock UCI engine.')
+    parser.add_argument('-s', '--stages', type=lambda s: s.split(','), default=list(STAGES),
+                        help='comma-separated stages to run, out of {}'.format(','.join(STAGES)))
+    parser.add_argument('-c', '--count', type=int, default=1000, help='number of generated positions')
+    parser.add_argument('-d', '--depth', type=int, default=4, help='puzzler search depth')
+    parser.add_argument('-l', '--latency', type=int, default=0, help='simulated engine time per depth in milliseconds')
+    parser.add_argument('-v', '--variant', default='chess', help='variant of the generated positions')
+    parser.add_argument('--shogi-variant', default='shogi', help='variant of the generated positions for the kif stage')
+    parser.add_argument('--workdir', help='directory to keep the generated files in (default: temporary directory)')
+    parser.add_argument('--save-baseline', help='JSON file to store the results to')
+    parser.add_argument('--baseline', help='JSON file with stored results to compare to, fails on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative throughput drop compared to the baseline')
+    args = parser.parse_args()
+
+    unknown = [stage for stage in args.stages if stage not in STAGES]
+    if unknown:
+        parser.error('unknown stages: {}'.format(','.join(unknown)))
+    settings = {'count': args.count, 'depth': args.depth, 'latency': args.latency, 'variant': args.variant, 'shogi_variant': args.shogi_variant}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != settings:
+            sys.stderr.write('Warning: Baseline was measured with different settings: {}\n'.format(baseline.get('settings')))
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args.workdir, args.stages, args.count, args.depth, args.latency, args.variant, args.shogi_variant)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run_benchmarks(workdir, args.stages, args.count, args.depth, args.latency, args.variant, args.shogi_variant)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'settings': settings, 'stages': results}, f, indent=2)
+            f.write('\n')
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.stderr.write('Throughput regressions of more than {:.0%}: {}\n'.format(args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,69 @@
+import json
+import sqlite3
+import time
+
+
+# Options that do not change analyses, or that are keyed separately, like MultiPV and the variant.
+NEUTRAL_OPTIONS = {'hash', 'threads', 'ponder', 'move overhead', 'debug log file', 'clear hash', 'multipv', 'uci_variant'}
+
+
+def engine_key(engine_id, options):
+    """Return the engine name with its options that affect analyses in canonical order, e.g., network and variant configuration files."""
+    relevant = sorted((str(name).lower(), str(value)) for name, value in options.items() if str(name).lower() not in NEUTRAL_OPTIONS)
+    return ' '.join([engine_id] + ['{}={}'.format(name, value) for name, value in relevant])
+
+
+class AnalysisCache():
+    """
+    Persistent cache of parsed engine analyses stored in an SQLite database.
+    Entries are keyed by engine, see engine_key, variant, FEN, moves and multipv and keep the deepest analysis seen,
+    so that a search can be skipped whenever a cached analysis of at least the requested depth exists.
+    When the cache grows beyond max_entries, the least recently used entries are evicted.
+    """
+
+    EVICTION_INTERVAL = 1000
+
+    def __init__(self, path, max_entries=1000000):
+        self.max_entries = max_entries
+        self.puts = 0
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS analysis (
+                                           engine TEXT, variant TEXT, fen TEXT, moves TEXT, multipv INTEGER,
+                                           depth INTEGER, infos TEXT, last_used REAL,
+                                           PRIMARY KEY (engine, variant, fen, moves, multipv))''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS analysis_last_used ON analysis (last_used)')
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, engine, variant, fen, moves, multipv, depth):
+        """Return the infos up to the given depth, or None if there is no cached analysis of sufficient depth."""
+        key = (engine, variant, fen, ' '.join(moves), multipv)
+        row = self.connection.execute('SELECT depth, infos FROM analysis WHERE engine=? AND variant=? AND fen=? AND moves=? AND multipv=?',
+                                      key).fetchone()
+        if row is None or row[0] < depth:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE analysis SET last_used=? WHERE engine=? AND variant=? AND fen=? AND moves=? AND multipv=?',
+                                    (time.time(),) + key)
+        return [multipv_info for multipv_info in json.loads(row[1]) if multipv_info[0].get('depth', 0) <= depth]
+
+    def put(self, engine, variant, fen, moves, multipv, depth, infos):
+        with self.connection:
+            self.connection.execute('''INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT DO UPDATE SET depth=excluded.depth, infos=excluded.infos, last_used=excluded.last_used
+                                       WHERE excluded.depth >= analysis.depth''',
+                                    (engine, variant, fen, ' '.join(moves), multipv, depth, json.dumps(infos), time.time()))
+        self.puts += 1
+        if self.puts % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        count = self.connection.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+        if count > self.max_entries:
+            with self.connection:
+                self.connection.execute('DELETE FROM analysis WHERE rowid IN (SELECT rowid FROM analysis ORDER BY last_used, rowid LIMIT ?)',
+                                        (count - self.max_entries,))
@@ -1,27 +1,29 @@
 import argparse
-from collections import defaultdict
-from functools import partial
-import fileinput
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import heapq
 from math import log
+import os
 import re
+import shutil
+import sqlite3
 import sys
+import tempfile
 
+import numpy as np
 import pyffish
 from tqdm import tqdm
 
-
-def line_count(filename):
-    f = open(filename, 'rb')
-    bufgen = iter(partial(f.raw.read, 1024*1024), b'')
-    return sum(buf.count(b'\n') for buf in bufgen)
+from epdfile import EpdReader, EpdRecord, parse_range, parse_shard
 
 
 def get_sort_key(sort_criteria, epd):
-    annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
+    record = EpdRecord(epd)
     key = []
     if sort_criteria:
         for crit, direction in sort_criteria:
-            val = annotations.get(crit, '')
+            val = record.get(crit, '')
             try:
                 v = float(val)
             except Exception:
@@ -35,6 +37,41 @@ def get_sort_key(sort_criteria, epd):
     return tuple(key)
 
 
+def chunked(lines, max_bytes):
+    """Yield lists of consecutive lines with a total length of at most max_bytes, or of a single longer line."""
+    chunk, size = [], 0
+    for line in lines:
+        if chunk and size + len(line) > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield chunk
+
+
+def external_sort(lines, key, max_bytes):
+    """
+    Yield the lines sorted by key, keeping the order of lines with equal keys.
+    Runs of at most max_bytes are sorted in memory and all but the last one are spilled to temporary files, then the runs are merged.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths, run = [], []
+        for chunk in chunked(lines, max_bytes):
+            if run:
+                paths.append(os.path.join(tmpdir, str(len(paths))))
+                with open(paths[-1], 'w', encoding='utf-8', newline='') as f:
+                    f.writelines(line if line.endswith('\n') else line + '\n' for line in run)
+            run = sorted(chunk, key=key)
+        files = [open(path, encoding='utf-8', newline='') for path in paths]
+        try:
+            # merging is stable, lines with equal keys are taken from earlier runs first
+            yield from heapq.merge(*files, run, key=key)
+        finally:
+            for f in files:
+                f.close()
+
+
 LAN_REGEX = re.compile(r'([A-Z])?([a-l][0-9]+)[-x]([a-l][0-9]+)')
 
 def parse_lan_move(move):
@@ -73,67 +110,481 @@ def fen_to_square_map(fen):
     return square_map
 
 
-def deduplicate(instream, outstream, king, sort_criteria=None, board_similarity_threshold=0.8, move_similarity_threshold=0.8, overall_similarity_threshold=0.5, verbosity=0):
-    epds = [epd for epd in instream]
-    if sort_criteria:
-        epds.sort(key=lambda x: get_sort_key(sort_criteria, x))
-
-    patterns = defaultdict(list)
-    unique = list()
-    for epd in tqdm(epds, total=len(epds)):
-        fen = epd.split(';')[0]
-        annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
-        variant = annotations.get('variant')
-        moves = [m for m in annotations.get('pv', '').split(",") if m]
-        final_fen = pyffish.get_fen(variant, fen, moves)
-        pieces = fen_to_square_map(final_fen)
-        board = frozenset(pieces.items())
-
-        # find king
-        side_to_move = final_fen.split()[1]
-        king_piece = king.upper() if side_to_move == 'w' else king.lower()
-        king_squares = "".join([k for k, v in pieces.items() if v == king_piece])
-
-        # Convert PV to LAN
-        lans = pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_LAN)
-        piece, _, to_sq = parse_lan_move(lans[-1])
-        sans = tuple(pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_SAN))
-
-        # Determine mating pattern
-        pattern = f"{piece}-{to_sq}-{king_piece}-{king_squares}"
-
-        # similarity check
-        for puzzle2 in unique:
-            matching_pairs = sum(1 for item in board if item in puzzle2['board'])
-            board_similarity = 2 * matching_pairs / (len(board) + len(puzzle2['board']))
-
-            # Compare SANs from the back
-            min_len = min(len(sans), len(puzzle2['sans']))
-            matching_sans = 0
-            for i in range(1, min_len + 1):
-                if sans[-i] == puzzle2['sans'][-i]:
-                    matching_sans += 1
-            move_similarity = matching_sans / min_len
-
-            overall_similarity = board_similarity * move_similarity
-
-            if (board_similarity > board_similarity_threshold or
-               move_similarity > move_similarity_threshold or
-               overall_similarity > overall_similarity_threshold):
-                if verbosity > 1:
-                    sys.stderr.write(f"Pattern: {pattern}, Board similarity: {board_similarity:.2f}, Move similarity: {move_similarity:.2f}, Overall similarity: {overall_similarity:.2f}\n{epd}{puzzle2['epd']}\n")
-                break
+def position_features(variant, fen, moves):
+    """Return the final FEN, the last move in LAN and the SAN moves of a puzzle line. These are the parts that require pyffish."""
+    final_fen = pyffish.get_fen(variant, fen, moves)
+    lans = pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_LAN)
+    sans = tuple(pyffish.get_san_moves(variant, fen, moves, False, pyffish.NOTATION_SAN))
+    return final_fen, lans[-1], sans
+
+
+def position_features_chunk(keys):
+    return [position_features(variant, fen, list(moves)) for variant, fen, moves in keys]
+
+
+def puzzle_features(final_fen, lan, sans, king):
+    """Return the board as a set of (square, piece) items, the SAN moves and the mating pattern of the final position of a puzzle."""
+    pieces = fen_to_square_map(final_fen)
+    board = frozenset(pieces.items())
+
+    # find king
+    side_to_move = final_fen.split()[1]
+    king_piece = king.upper() if side_to_move == 'w' else king.lower()
+    king_squares = "".join([k for k, v in pieces.items() if v == king_piece])
+
+    piece, _, to_sq = parse_lan_move(lan)
+
+    # Determine mating pattern
+    pattern = f"{piece}-{to_sq}-{king_piece}-{king_squares}"
+    return board, sans, pattern
+
+
+class FeatureCache():
+    """
+    Persistent cache of the position features of puzzle lines in an SQLite database, see position_features,
+    so that repeated deduplication runs, e.g., with different thresholds, do not need to call pyffish.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS features (
+                                           variant TEXT, fen TEXT, moves TEXT, final_fen TEXT, lan TEXT, sans TEXT,
+                                           PRIMARY KEY (variant, fen, moves))''')
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, variant, fen, moves):
+        row = self.connection.execute('SELECT final_fen, lan, sans FROM features WHERE variant=? AND fen=? AND moves=?',
+                                      (variant, fen, ' '.join(moves))).fetchone()
+        return None if row is None else (row[0], row[1], tuple(row[2].split(' ')))
+
+    def put_many(self, items):
+        """Store (variant, fen, moves) keys with their features."""
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(variant, fen, ' '.join(moves), final_fen, lan, ' '.join(sans))
+                                         for (variant, fen, moves), (final_fen, lan, sans) in items])
+
+
+def extract_features(epds, king, workers=1, cache=None, chunk_size=1000, progress=None):
+    """
+    Return the board, SAN moves and pattern of each puzzle, see puzzle_features.
+    Position features missing from the cache are computed in chunks by a pool of worker processes and added to the cache.
+    Progress is shown on the given tqdm progress bar, or on a new one.
+    """
+    keys = []
+    for epd in epds:
+        record = EpdRecord(epd)
+        keys.append((record.get('variant'), record.fen, tuple(record.moves())))
+    features = [cache.get(*key) if cache else None for key in keys]
+    missing = [i for i, feature in enumerate(features) if feature is None]
+    # several chunks per worker to balance the load, but not too small to keep the inter-process overhead low
+    chunk_size = max(10, min(chunk_size, -(-len(missing) // (4 * workers))))
+    chunks = [[keys[i] for i in missing[start:start + chunk_size]] for start in range(0, len(missing), chunk_size)]
+
+    with tqdm(total=len(missing), disable=progress is not None) as pbar:
+        pbar = pbar if progress is None else progress
+
+        def computed(results):
+            for chunk, chunk_features in zip(chunks, results):
+                if cache:
+                    cache.put_many(zip(chunk, chunk_features))
+                pbar.update(len(chunk))
+                yield from chunk_features
+
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for i, feature in zip(missing, computed(executor.map(position_features_chunk, chunks))):
+                    features[i] = feature
         else:
-            if pattern not in patterns:
+            for i, feature in zip(missing, computed(map(position_features_chunk, chunks))):
+                features[i] = feature
+    return [puzzle_features(final_fen, lan, sans, king) for final_fen, lan, sans in features]
+
+
+def board_similarity(board, board2):
+    return 2 * len(board & board2) / (len(board) + len(board2))
+
+
+def move_similarity(sans, sans2):
+    """Return the fraction of matching SAN moves, compared from the back."""
+    min_len = min(len(sans), len(sans2))
+    matching_sans = 0
+    for i in range(1, min_len + 1):
+        if sans[-i] == sans2[-i]:
+            matching_sans += 1
+    return matching_sans / min_len
+
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcounts(rows):
+    """Return the number of set bits per row of a uint8 matrix whose width is a multiple of 8."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(rows.view(np.uint64)).sum(axis=1, dtype=np.int64)
+    return POPCOUNT[rows].sum(axis=1, dtype=np.int64)
+
+
+def format_item(item):
+    square, piece = item
+    return square + piece
+
+
+def parse_item(text):
+    return text[:-1], text[-1]
+
+
+def format_move_key(key):
+    position, san = key
+    return '{} {}'.format(position, san)
+
+
+def lookup_postings(keys, offsets, postings, queries):
+    """Return the postings of the queries that are among the sorted keys, whose postings are concatenated at the offsets."""
+    if not len(keys) or not len(queries):
+        return []
+    positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    positions = positions[keys[positions] == queries]
+    return [postings[start:end] for start, end in zip(offsets[positions].tolist(), offsets[positions + 1].tolist())]
+
+
+def postings_arrays(name, index, format_key):
+    """Return the postings of an inverted index as arrays of the sorted keys, the offsets of their postings and the concatenated postings."""
+    postings = sorted((format_key(key), key_postings) for key, key_postings in index.items())
+    return {
+        name + '_keys': np.array([key for key, _ in postings], dtype=str),
+        name + '_offsets': np.concatenate([[0], np.cumsum([len(key_postings) for _, key_postings in postings], dtype=np.int64)]),
+        name + '_postings': np.frombuffer(b''.join(key_postings.tobytes() for _, key_postings in postings), dtype=np.int64),
+    }
+
+
+class SimilarityIndex():
+    """
+    Finds the first of the retained puzzles that is similar to a new one, without comparing against all of them.
+
+    Puzzles are only compared exactly with candidates from two inverted indices:
+    * Boards are indexed by a prefix of their items in a global order with rare items first, which is long enough that
+      two boards with a board similarity above the threshold always share an item of their prefixes (prefix filtering).
+    * SAN moves are indexed by their position counted from the back, which directly yields the number of matching moves.
+      The product of the similarities can only exceed its threshold if the move similarity does,
+      so all pairs with a move similarity above the lower of both thresholds are candidates.
+    Boards are stored as rows of a bit matrix with one bit per distinct (square, piece) item, including the pseudo-squares of pieces in hand,
+    so that the similarities of all candidates are computed at once.
+    The result is the same as comparing with every retained puzzle in order.
+    The EPD lines of retained puzzles are only kept if given, to report the similar puzzle.
+    """
+
+    def __init__(self, board_threshold, move_threshold, overall_threshold, item_order=None, stored=()):
+        self.board_threshold = board_threshold
+        self.move_threshold = move_threshold
+        self.overall_threshold = overall_threshold
+        self.move_candidate_threshold = min(move_threshold, overall_threshold)
+        # negative thresholds also match puzzles without anything in common
+        self.compare_all = min(board_threshold, move_threshold, overall_threshold) < 0
+        # items not in the order rank before all others, in order of appearance, so that the order never changes for indexed items
+        self.item_order = dict(item_order or {})
+        self.item_bits = {}
+        self.count = 0
+        self.boards = np.zeros((16, 0), dtype=np.uint8)
+        self.board_sizes = np.zeros(16, dtype=np.int64)
+        self.move_counts = np.zeros(16, dtype=np.int64)
+        self.epds = []
+        # postings are stored as compact 64 bit integer arrays
+        self.board_index = defaultdict(lambda: array('q'))
+        self.move_index = defaultdict(lambda: array('q'))
+        self.postings = 0
+        # puzzles of earlier runs stay in their stored segments, only the puzzles added later are kept in memory
+        self.stored = list(stored)
+        for segment in self.stored:
+            self.item_order.update(zip(map(parse_item, segment.arrays['items']), map(int, segment.arrays['item_ranks'])))
+            self.item_bits.update(zip(map(parse_item, segment.arrays['bit_items']), map(int, segment.arrays['item_bits'])))
+        self.stored_items = len(self.item_order)
+        self.stored_bits = len(self.item_bits)
+        self.start = self.count = sum(map(len, self.stored))
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        """Return a rough estimate of the memory used by the retained puzzles."""
+        keys = len(self.item_order) + len(self.board_index) + len(self.move_index)
+        return self.boards.nbytes + self.board_sizes.nbytes + self.move_counts.nbytes + 8 * self.postings + 200 * keys + sum(map(len, self.epds))
+
+    def encode(self, board):
+        """Return the board as packed bits, adding bits for new items."""
+        for item in board:
+            if item not in self.item_bits:
+                self.item_bits[item] = len(self.item_bits)
+        # rows are padded to whole 64 bit words
+        width = -(-len(self.item_bits) // 64) * 8
+        if width > self.boards.shape[1]:
+            self.boards = np.pad(self.boards, ((0, 0), (0, width - self.boards.shape[1])))
+        bits = np.zeros(width * 8, dtype=np.uint8)
+        bits[[self.item_bits[item] for item in board]] = 1
+        return np.packbits(bits)
+
+    def board_prefix(self, board):
+        for item in board:
+            if item not in self.item_order:
+                self.item_order[item] = -len(self.item_order) - 1
+        items = sorted(board, key=self.item_order.__getitem__)
+        # smallest overlap a board of any size needs for a similarity above the threshold
+        min_overlap = int(self.board_threshold * len(board) / (2 - self.board_threshold) - 1e-9) + 1 if self.board_threshold < 2 else len(board) + 1
+        return items[:max(len(board) - min_overlap + 1, 0)]
+
+    def lookup(self, name, index, keys, format_key):
+        """Return the postings of the keys, in the stored segments and in memory."""
+        postings = [index[key] for key in keys if key in index]
+        if self.stored:
+            queries = np.array([format_key(key) for key in keys], dtype=str)
+            for segment in self.stored:
+                postings += segment.lookup(name, queries)
+        return postings
+
+    def split(self, indices):
+        """Split sorted indices into the stored segments and the puzzles in memory, as pairs of the part and the indices relative to its start."""
+        if not self.stored:
+            return [(self, indices - self.start)]
+        parts = self.stored + [self]
+        splits = np.split(indices, np.searchsorted(indices, [part.start for part in parts[1:]]))
+        return [(part, part_indices - part.start) for part, part_indices in zip(parts, splits) if len(part_indices)] or [(self, indices - self.start)]
+
+    def gather(self, name, indices):
+        return np.concatenate([getattr(part, name)[part_indices] for part, part_indices in self.split(indices)])
+
+    def candidates(self, board, sans):
+        """Return the sorted indices of the candidates and their numbers of matching SAN moves."""
+        postings = self.lookup('move', self.move_index, list(enumerate(reversed(sans))), format_move_key)
+        matched = np.concatenate(postings) if postings else np.zeros(0, dtype=np.int64)
+        if self.compare_all:
+            return np.arange(self.count), np.bincount(matched, minlength=self.count)
+        matched, matches = np.unique(matched, return_counts=True)
+        move_candidates = matched[matches / np.minimum(len(sans), self.gather('move_counts', matched)) > self.move_candidate_threshold]
+        board_postings = self.lookup('board', self.board_index, self.board_prefix(board), format_item)
+        candidates = np.union1d(move_candidates, np.concatenate(board_postings) if board_postings else np.zeros(0, dtype=np.int64))
+        in_candidates = np.isin(matched, candidates)
+        candidate_matches = np.zeros(len(candidates), dtype=np.int64)
+        candidate_matches[np.searchsorted(candidates, matched[in_candidates])] = matches[in_candidates]
+        return candidates, candidate_matches
+
+    def find(self, board, sans):
+        """Return the index and the board, move and overall similarity of the first similar retained puzzle, or None."""
+        candidates, matches = self.candidates(board, sans)
+        if not len(candidates):
+            return None
+        # encoding first adds the bits of new items to the matrix
+        row = self.encode(board)
+        # rows of earlier segments are narrower, as they cannot contain items added later
+        overlaps = np.concatenate([popcounts(part.boards[part_indices] & row[:part.boards.shape[1]]) for part, part_indices in self.split(candidates)])
+        board_sims = 2 * overlaps / (len(board) + self.gather('board_sizes', candidates))
+        move_sims = matches / np.minimum(len(sans), self.gather('move_counts', candidates))
+        overall_sims = board_sims * move_sims
+        similar = np.flatnonzero((board_sims > self.board_threshold) | (move_sims > self.move_threshold) | (overall_sims > self.overall_threshold))
+        if not len(similar):
+            return None
+        first = similar[0]
+        return int(candidates[first]), float(board_sims[first]), float(move_sims[first]), float(overall_sims[first])
+
+    def add(self, board, sans, epd=None):
+        i = self.count
+        row = self.encode(board)
+        local = i - self.start
+        if local == len(self.boards):
+            self.boards = np.concatenate([self.boards, np.zeros_like(self.boards)])
+            self.board_sizes = np.concatenate([self.board_sizes, np.zeros_like(self.board_sizes)])
+            self.move_counts = np.concatenate([self.move_counts, np.zeros_like(self.move_counts)])
+        self.boards[local] = row
+        self.board_sizes[local] = len(board)
+        self.move_counts[local] = len(sans)
+        if epd is not None:
+            self.epds.append(epd)
+        self.count += 1
+        prefix = self.board_prefix(board)
+        for item in prefix:
+            self.board_index[item].append(i)
+        for key in enumerate(reversed(sans)):
+            self.move_index[key].append(i)
+        self.postings += len(prefix) + len(sans)
+
+    def arrays(self):
+        """Return the puzzles and items added after the stored segments as arrays to store as a segment."""
+        count = self.count - self.start
+        items = list(self.item_order)[self.stored_items:]
+        bit_items = list(self.item_bits)[self.stored_bits:]
+        return {
+            'thresholds': np.array([self.board_threshold, self.move_threshold, self.overall_threshold]),
+            'boards': self.boards[:count],
+            'board_sizes': self.board_sizes[:count],
+            'move_counts': self.move_counts[:count],
+            'items': np.array([format_item(item) for item in items], dtype=str),
+            'item_ranks': np.array([self.item_order[item] for item in items], dtype=np.int64),
+            'bit_items': np.array([format_item(item) for item in bit_items], dtype=str),
+            'item_bits': np.array([self.item_bits[item] for item in bit_items], dtype=np.int64),
+            **postings_arrays('board', self.board_index, format_item),
+            **postings_arrays('move', self.move_index, format_move_key),
+        }
+
+
+class IndexSegment():
+    """The puzzles written by one deduplication run, stored as a directory of NumPy arrays that are memory-mapped when loaded."""
+
+    ARRAYS = ('thresholds', 'boards', 'board_sizes', 'move_counts', 'items', 'item_ranks', 'bit_items', 'item_bits',
+              'board_keys', 'board_offsets', 'board_postings', 'move_keys', 'move_offsets', 'move_postings', 'patterns')
+
+    def __init__(self, path, start):
+        self.start = start
+        # plain views of the memory maps are faster to index
+        self.arrays = {name: np.asarray(np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in self.ARRAYS}
+        self.boards = self.arrays['boards']
+        self.board_sizes = self.arrays['board_sizes']
+        self.move_counts = self.arrays['move_counts']
+
+    def __len__(self):
+        return len(self.board_sizes)
+
+    def lookup(self, name, queries):
+        return lookup_postings(self.arrays[name + '_keys'], self.arrays[name + '_offsets'], self.arrays[name + '_postings'], queries)
+
+    def has_pattern(self, pattern):
+        patterns = self.arrays['patterns']
+        i = np.searchsorted(patterns, pattern)
+        return i < len(patterns) and patterns[i] == pattern
+
+
+class PuzzleIndex():
+    """
+    Index of the puzzles written by deduplication runs, so that new puzzles can be deduplicated against them
+    without processing them again. Each run that writes puzzles adds a segment with their packed boards, their sizes,
+    the postings of the similarity index and the new mating patterns. Segments are never changed and only memory-mapped,
+    so a run only reads the parts of the index it looks up and only writes its own puzzles.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        if os.path.exists(path):
+            if not os.path.isdir(path):
+                raise Exception('{} is not a puzzle index'.format(path))
+            for name in sorted(name for name in os.listdir(path) if name.isdigit()):
+                self.segments.append(IndexSegment(os.path.join(path, name), len(self)))
+
+    def __len__(self):
+        return sum(map(len, self.segments))
+
+    def board_threshold(self):
+        """Return the highest board similarity threshold that the board prefixes of the segments were selected for."""
+        return max((float(segment.arrays['thresholds'][0]) for segment in self.segments), default=float('-inf'))
+
+    def similarity_index(self, board_threshold, move_threshold, overall_threshold):
+        # stored prefixes are too short to find all similar boards for a lower threshold
+        if board_threshold < self.board_threshold():
+            raise ValueError('{} was built with a board similarity threshold of {}, it cannot be used with a lower one'.format(self.path, self.board_threshold()))
+        return SimilarityIndex(board_threshold, move_threshold, overall_threshold, stored=self.segments)
+
+    def has_pattern(self, pattern):
+        return any(segment.has_pattern(pattern) for segment in self.segments)
+
+    def save(self, similarity_index, patterns):
+        """Store the puzzles added to the similarity index and their patterns as a new segment."""
+        arrays = similarity_index.arrays()
+        if not len(arrays['board_sizes']):
+            return
+        arrays['patterns'] = np.array(sorted(pattern for pattern in patterns if not self.has_pattern(pattern)), dtype=str)
+        # the segment only appears once it is complete
+        path = os.path.join(self.path, '{:08d}'.format(len(self.segments)))
+        shutil.rmtree(path + '.new', ignore_errors=True)
+        os.makedirs(path + '.new')
+        for name in IndexSegment.ARRAYS:
+            np.save(os.path.join(path + '.new', name + '.npy'), arrays[name])
+        os.rename(path + '.new', path)
+        self.segments.append(IndexSegment(path, len(self)))
+
+
+def input_batches(instream, sort_criteria=None, max_memory=None):
+    """
+    Return the input as a single sorted batch, or with max_memory in bytes, as batches of the streamed input,
+    which is sorted externally if required.
+    """
+    sort_key = lambda x: get_sort_key(sort_criteria, x)
+    if max_memory is None:
+        epds = [epd for epd in instream]
+        if sort_criteria:
+            epds.sort(key=sort_key)
+        return [epds]
+    if sort_criteria:
+        instream = external_sort(instream, sort_key, max_memory // 4)
+    # features take several times the size of their lines
+    return chunked(instream, max_memory // 32)
+
+
+def rare_items_first(features):
+    """Return the ranks of the board items of the features with rare items first, to keep the prefixes of the board index selective."""
+    item_counts = Counter(item for board, _, _ in features for item in board)
+    return {item: rank for rank, (item, _) in enumerate(sorted(item_counts.items(), key=lambda x: (x[1], x[0])))}
+
+
+def deduplicate_batch(epds, features, outstream, unique, patterns, index=None, keep_epds=True, verbosity=0, retained=None):
+    """
+    Write the puzzles of a batch that are not similar to a retained puzzle and whose mating pattern is new, and retain them.
+    Patterns are counted in patterns, including those written by earlier runs that are in the index.
+    """
+    for epd, (board, sans, pattern) in zip(epds, features):
+        similar = unique.find(board, sans)
+        if similar:
+            if verbosity > 1:
+                i, board_sim, move_sim, overall_sim = similar
+                sys.stderr.write(f"Pattern: {pattern}, Board similarity: {board_sim:.2f}, Move similarity: {move_sim:.2f}, Overall similarity: {overall_sim:.2f}\n{epd}{retained(i)}\n")
+            continue
+        if pattern not in patterns:
+            if index is not None and index.has_pattern(pattern):
+                # count the occurrence written by an earlier run
+                patterns[pattern] += 1
+            else:
                 # If this is the first occurrence of the pattern, write it
                 outstream.write(epd)
-                unique.append({'board': board, 'sans': sans, 'epd': epd})
-            patterns[pattern].append(epd)
+                unique.add(board, sans, epd if keep_epds else None)
+        patterns[pattern] += 1
+
+
+def deduplicate(instream, outstream, king, sort_criteria=None, board_similarity_threshold=0.8, move_similarity_threshold=0.8, overall_similarity_threshold=0.5, verbosity=0,
+                workers=1, feature_cache=None, max_memory=None, index=None):
+    """
+    Write the first puzzle of each mating pattern that is not similar to an already written one.
+    With max_memory in bytes, the input is streamed in batches instead of loaded at once, and sorted externally if required.
+    max_memory only sizes the batches and the sort, the memory of the retained puzzles is not limited.
+    Then only compact features of the written puzzles are kept, and the rare items of the board index are estimated from the first batch.
+    With a PuzzleIndex, puzzles similar to its puzzles are also skipped, and the written puzzles are added to it at the end.
+    """
+    thresholds = (board_similarity_threshold, move_similarity_threshold, overall_similarity_threshold)
+    patterns = Counter()
+    known = len(index) if index is not None else 0
+    unique = index.similarity_index(*thresholds) if known else None
+
+    def retained(i):
+        if i < known:
+            return f"Indexed puzzle {i + 1}\n"
+        return unique.epds[i - known] if max_memory is None else f"Output line {i - known + 1}\n"
+
+    with tqdm(disable=max_memory is None) as pbar:
+        for epds in input_batches(instream, sort_criteria, max_memory):
+            features = extract_features(epds, king, workers, feature_cache, progress=pbar if max_memory else None)
+            if unique is None:
+                unique = SimilarityIndex(*thresholds, rare_items_first(features))
+            deduplicate_batch(epds, features, outstream, unique, patterns, index, max_memory is None, verbosity, retained)
+            if max_memory and unique.nbytes() > max(max_memory // 2, 1 << 20):
+                sys.stderr.write('Warning: Retained puzzles use about {} MB, more than half of the memory limit\n'.format(unique.nbytes() >> 20))
+
+    if index is not None and unique is not None:
+        index.save(unique, patterns)
 
     if verbosity:
-        for pattern, epd_list in sorted(patterns.items(), key=lambda x: len(x[1]), reverse=True):
-            if len(epd_list) > 1:
-                sys.stderr.write(f"{pattern}: {len(epd_list)} -> 1\n")
+        for pattern, count in sorted(patterns.items(), key=lambda x: x[1], reverse=True):
+            if count > 1:
+                sys.stderr.write(f"{pattern}: {count} -> 1\n")
 
 
 if __name__ == '__main__':
@@ -146,13 +597,32 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--move-similarity', type=float, default=0.8, help='Similarity threshold for SAN deduplication (default: 0.8)')
     parser.add_argument('-o', '--overall-similarity', type=float, default=0.5, help='Similarity threshold for the product of board and move similarity (default: 0.5)')
     parser.add_argument('-v', '--verbosity', type=int, default=0, help='Enable verbose output for similarity checks')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes to compute the final positions and SAN moves with')
+    parser.add_argument('--feature-cache', help='SQLite file to store and reuse the final positions and SAN moves across runs')
+    parser.add_argument('--max-memory', type=int, help='stream the input instead of loading it at once, in batches and with an external sort sized for about this many MB, '
+                                                        'and only keep compact features of the written puzzles, whose memory is not limited')
+    parser.add_argument('--index', help='directory with an index of previously written puzzles to also deduplicate against, the written puzzles are added to it')
+    parser.add_argument('--range', type=parse_range, help='only deduplicate the lines start:end of the input, counting from 0')
+    parser.add_argument('--shard', type=parse_shard, help='only deduplicate the i-th of N equally sized parts of the input, counting from 0, written as i/N')
     args = parser.parse_args()
+    if (args.range or args.shard) and (not args.epd_files or '-' in args.epd_files):
+        parser.error('--range and --shard require input files')
 
-    with fileinput.input(args.epd_files) as instream:
-        deduplicate(
-            instream, sys.stdout, args.king, args.sort,
-            board_similarity_threshold=args.board_similarity,
-            move_similarity_threshold=args.move_similarity,
-            overall_similarity_threshold=args.overall_similarity,
-            verbosity=args.verbosity
-        )
+    instream = EpdReader(args.epd_files, args.range, args.shard, progress=True)
+    feature_cache = FeatureCache(args.feature_cache) if args.feature_cache else None
+    index = PuzzleIndex(args.index) if args.index else None
+    if index and args.board_similarity < index.board_threshold():
+        parser.error('--index was built with a board similarity threshold of {}, use at least that or a new index'.format(index.board_threshold()))
+    deduplicate(
+        instream, sys.stdout, args.king, args.sort,
+        board_similarity_threshold=args.board_similarity,
+        move_similarity_threshold=args.move_similarity,
+        overall_similarity_threshold=args.overall_similarity,
+        verbosity=args.verbosity,
+        workers=args.workers,
+        feature_cache=feature_cache,
+        max_memory=args.max_memory << 20 if args.max_memory else None,
+        index=index
+    )
+    if feature_cache:
+        feature_cache.close()
@@ -0,0 +1,268 @@
+import argparse
+from functools import partial
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+
+def parse_range(value):
+    """Parse a start:end range of line numbers for argparse. Line numbers start at 0, the end is exclusive and either bound can be omitted."""
+    try:
+        start, end = (int(bound) if bound else None for bound in value.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected start:end, got {}'.format(value))
+    if (start or 0) < 0 or (end is not None and end < 0):
+        raise argparse.ArgumentTypeError('line numbers need to be non-negative')
+    return start or 0, end
+
+
+def parse_shard(value):
+    """Parse a shard i/N for argparse, where 0 <= i < N."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, got {}'.format(value))
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('shard index needs to be in [0, N)')
+    return index, count
+
+
+class LineIndex():
+    """
+    Sparse index of the byte offsets of every STEP-th line of a file. It is stored next to the file as <file>.idx
+    and rebuilt when the file changes. Lines in between are found by skipping less than STEP lines.
+    """
+
+    STEP = 1024
+    MAGIC = b'EPDIDX1\n'
+    HEADER = struct.Struct('<8sQQQQ')
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        if not self._load():
+            self._build()
+            self._save()
+
+    def _load(self):
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                magic, size, mtime, lines, step = self.HEADER.unpack(f.read(self.HEADER.size))
+                if (magic, size, mtime, step) != (self.MAGIC, self.size, self.mtime, self.STEP):
+                    return False
+                self.lines = lines
+                self.offsets = np.frombuffer(f.read(), dtype='<u8')
+                return True
+        except (OSError, struct.error):
+            return False
+
+    def _build(self):
+        offsets = [np.zeros(1, dtype=np.uint64)]
+        lines = 0
+        position = 0
+        last = b'\n'
+        with open(self.path, 'rb') as f:
+            for chunk in iter(partial(f.read, 1 << 24), b''):
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+                # a line starts after each newline, keep those with a line number divisible by STEP
+                offsets.append(newlines[-(lines + 1) % self.STEP::self.STEP].astype(np.uint64) + position + 1)
+                lines += len(newlines)
+                position += len(chunk)
+                last = chunk[-1:]
+        self.lines = lines + (last != b'\n')
+        self.offsets = np.concatenate(offsets)
+
+    def _save(self):
+        try:
+            with open(self.path + '.idx.tmp', 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.size, self.mtime, self.lines, self.STEP))
+                f.write(self.offsets.astype('<u8').tobytes())
+            os.replace(self.path + '.idx.tmp', self.path + '.idx')
+        except OSError as e:
+            sys.stderr.write('Warning: Could not save line index of {}: {}\n'.format(self.path, e))
+
+    def offset(self, line):
+        """Return the byte offset of the given line, or the file size for lines after the last one."""
+        if line >= self.lines:
+            return self.size
+        with open(self.path, 'rb') as f:
+            f.seek(int(self.offsets[line // self.STEP]))
+            for _ in range(line % self.STEP):
+                f.readline()
+            return f.tell()
+
+
+class EpdReader():
+    """
+    Iterates over the lines of EPD files, or of stdin for '-' or if there are no files, decoded as text.
+    The input can be restricted to a range of line numbers of the concatenated files and to one of N equally sized shards of that range.
+    Selections seek directly to their first line using line indices, see LineIndex.
+    Progress is measured in bytes, so the input does not need to be counted beforehand.
+    """
+
+    def __init__(self, filenames, line_range=None, shard=None, progress=False):
+        self.filenames = list(filenames) or ['-']
+        self.selection = None
+        self.progress = progress
+        self.position = (0, 0)
+        if line_range is None and shard is None:
+            self.segments = [(i, 0, None if filename == '-' else os.path.getsize(filename)) for i, filename in enumerate(self.filenames)]
+        else:
+            if '-' in self.filenames:
+                raise ValueError('Line ranges and shards require input files')
+            indices = [LineIndex(filename) for filename in self.filenames]
+            total_lines = sum(index.lines for index in indices)
+            first, last = line_range or (0, None)
+            last = total_lines if last is None else min(last, total_lines)
+            first = min(first, last)
+            if shard:
+                shard_index, shard_count = shard
+                first, last = first + (last - first) * shard_index // shard_count, first + (last - first) * (shard_index + 1) // shard_count
+            self.selection = [first, last]
+            self.segments = []
+            line = 0
+            for i, index in enumerate(indices):
+                start, end = max(first - line, 0), min(last - line, index.lines)
+                if start < end:
+                    self.segments.append((i, index.offset(start), index.offset(end)))
+                line += index.lines
+        self.total = None if any(end is None for _, _, end in self.segments) else sum(end - start for _, start, end in self.segments)
+        self.initial = 0
+
+    def seek(self, position):
+        """Continue reading after a (file index, byte offset) position returned by the position attribute."""
+        file_index, offset = position
+        segments = []
+        skipped = 0
+        for i, start, end in self.segments:
+            if i < file_index:
+                skipped += (end or 0) - start
+                continue
+            if i == file_index:
+                resume = max(offset, start) if end is None else min(max(offset, start), end)
+                skipped += resume - start
+                start = resume
+                if start == end:
+                    continue
+            segments.append((i, start, end))
+        self.segments = segments
+        self.initial += skipped
+        self.position = position
+
+    def __iter__(self):
+        pbar = tqdm(total=self.total, initial=self.initial, unit='B', unit_scale=True) if self.progress else None
+        try:
+            for file_index, start, end in self.segments:
+                f = sys.stdin.buffer if self.filenames[file_index] == '-' else open(self.filenames[file_index], 'rb')
+                try:
+                    if start:
+                        f.seek(start)
+                    position = start
+                    for line in f:
+                        if end is not None and position >= end:
+                            break
+                        position += len(line)
+                        self.position = (file_index, position)
+                        if pbar:
+                            pbar.update(len(line))
+                        yield line.decode()
+                finally:
+                    if f is not sys.stdin.buffer:
+                        f.close()
+        finally:
+            if pbar:
+                pbar.close()
+
+
+LOOSE_KEY_PATTERNS = {}
+
+
+def loose_key_pattern(key):
+    if key not in LOOSE_KEY_PATTERNS:
+        LOOSE_KEY_PATTERNS[key] = re.compile(r';\s*{}[ \t]'.format(re.escape(key)))
+    return LOOSE_KEY_PATTERNS[key]
+
+
+class EpdRecord():
+    """
+    An EPD line of a FEN followed by ;-separated "key value" annotations, which are parsed lazily.
+    An annotation is only located and split out of the line when it is accessed, and numbers are converted only once.
+    Annotations can be changed by item assignment, and an unchanged record is written back as the original line.
+    """
+
+    __slots__ = ('line', 'fen', '_values', '_numbers', '_changes')
+
+    def __init__(self, line):
+        self.line = line
+        end = line.find(';')
+        self.fen = line.strip() if end < 0 else line[:end].strip()
+        self._values = {}
+        self._numbers = {}
+        self._changes = {}
+
+    def _find(self, key):
+        # the last occurrence wins, like when building a dict of all annotations
+        start = self.line.rfind(';' + key + ' ')
+        if start >= 0:
+            start += len(key) + 2
+        else:
+            # tolerate whitespace around separators, e.g., "fen; variant shogi"
+            match = None
+            for match in loose_key_pattern(key).finditer(self.line):
+                pass
+            if match is None:
+                return None
+            start = match.end()
+        end = self.line.find(';', start)
+        return (self.line[start:] if end < 0 else self.line[start:end]).strip()
+
+    def get(self, key, default=None):
+        if key in self._changes:
+            return self._changes[key]
+        if key not in self._values:
+            self._values[key] = self._find(key)
+        value = self._values[key]
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+        self._numbers.pop(key, None)
+
+    def number(self, key, default=0):
+        """Return an annotation as a float, or the default if it is missing."""
+        if key not in self._numbers:
+            value = self.get(key)
+            if value is None:
+                return default
+            self._numbers[key] = float(value)
+        return self._numbers[key]
+
+    def moves(self, key='pv'):
+        """Return a comma-separated list of moves as a list, without empty moves."""
+        return [move for move in self.get(key, '').split(',') if move]
+
+    def annotations(self):
+        """Return all annotations, including changes, as a dict in line order."""
+        annotations = dict(token.strip().split(' ', 1) for token in self.line.split(';')[1:] if ' ' in token.strip())
+        annotations.update(self._changes)
+        return annotations
+
+    def __str__(self):
+        if not self._changes:
+            return self.line if self.line.endswith('\n') else self.line + '\n'
+        return '{};{}\n'.format(self.fen, ';'.join('{} {}'.format(k, v) for k, v in self.annotations().items()))
@@ -4,6 +4,8 @@ import csv
 
 import numpy as np
 
+from epdfile import EpdRecord
+
 
 def evaluate_puzzles(csv_stream, epd_files):
     fieldnames = ['PuzzleId', 'FEN', 'Moves', 'Rating', 'RatingDeviation', 'Popularity', 'NbPlays', 'Themes', 'GameUrl']
@@ -22,15 +24,13 @@ def evaluate_puzzles(csv_stream, epd_files):
             values = defaultdict(list)
             pv_length = list()
             for epd in epd_stream:
-                tokens = epd.strip().split(';')
-                fen = tokens[0]
-                annotations = dict(token.split(' ', 1) for token in tokens[1:])
-                ref_puzzle = puzzles[fen]
+                record = EpdRecord(epd)
+                ref_puzzle = puzzles[record.fen]
                 rating.append(float(ref_puzzle['Rating']))
                 popularity.append(float(ref_puzzle['Popularity']))
                 for k in ('volatility', 'volatility2', 'accuracy', 'accuracy2', 'content', 'difficulty', 'quality', 'std'):
-                    values[k].append(float(annotations.get(k, 0)))
-                pv_length.append(len(annotations.get('pv', '').split(',')))
+                    values[k].append(record.number(k))
+                pv_length.append(len(record.get('pv', '').split(',')))
                 solution_length.append(len(ref_puzzle['Moves'].split()))
                 count += 1
 
@@ -1,16 +1,12 @@
 import argparse
-import fileinput
-from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import sys
 
-from tqdm import tqdm
 import pyffish
 
-
-def line_count(filename):
-    f = open(filename, 'rb')
-    bufgen = iter(partial(f.raw.read, 1024*1024), b'')
-    return sum(buf.count(b'\n') for buf in bufgen)
+from epdfile import EpdReader, EpdRecord, parse_range, parse_shard
 
 
 def get_fen(variant, fen, moves):
@@ -34,45 +30,95 @@ def net_material(piece_values, fen):
         return black_total - white_total
 
 
-def final_net_material(piece_values, fen, annotations):
-    fen = get_fen(annotations['variant'], fen, annotations['pv'].split(',')) if 'pv' in annotations else fen
+def final_net_material(piece_values, record):
+    fen = get_fen(record['variant'], record.fen, record['pv'].split(',')) if 'pv' in record else record.fen
     return net_material(piece_values, fen)
 
 
-def filter(annotations, min, max, values):
+def material_annotations(piece_values):
+    """Return the inferred material annotations, ordered by cost."""
+    return {
+        'material': lambda record: net_material(piece_values, record.fen),
+        'finalmaterial': lambda record: -final_net_material(piece_values, record),
+        'materialdiff': lambda record: record.number('finalmaterial') - record.number('material'),
+    }
+
+
+class InferredRecord(EpdRecord):
+    """An EpdRecord whose inferred annotations are computed when first accessed, overriding the annotations of the line."""
+
+    __slots__ = ('inferred',)
+
+    def __init__(self, line, inferred_annotations):
+        super().__init__(line)
+        self.inferred = inferred_annotations
+
+    def get(self, key, default=None):
+        if key in self.inferred and key not in self._changes:
+            self[key] = self.inferred[key](self)
+        return super().get(key, default)
+
+
+def compile_filter(min, max, values, inferred_annotations=None):
+    """
+    Return a function that returns whether a record is filtered out, parsing the thresholds only once.
+    Annotations of the line are checked first, followed by the inferred annotations in the order given, which should be by cost.
+    """
+    inferred_annotations = inferred_annotations or {}
+    checks = []
     for k, v in min.items():
         if k == 'pv':
-            if len(annotations.get(k, '').split(',')) < int(v):
-                return True
-        elif float(annotations.get(k, 0)) < float(v):
-            return True
+            checks.append((k, lambda record, k=k, v=int(v): len(record.get(k, '').split(',')) < v))
+        else:
+            checks.append((k, lambda record, k=k, v=float(v): record.number(k) < v))
     for k, v in max.items():
-        if float(annotations.get(k, 0)) > float(v):
-            return True
+        checks.append((k, lambda record, k=k, v=float(v): record.number(k) > v))
     for k, v in values.items():
-        if annotations.get(k, 0) not in v.split(','):
-            return True
-    return False
+        checks.append((k, lambda record, k=k, v=frozenset(v.split(',')): record.get(k, 0) not in v))
+    order = list(inferred_annotations)
+    checks.sort(key=lambda check: order.index(check[0]) + 1 if check[0] in inferred_annotations else 0)
+    checks = [check for _, check in checks]
+    return lambda record: any(check(record) for check in checks)
 
 
 def filter_puzzles(instream, outstream, min, max, values, inferred_annotations):
-    # Before the first line has been read, filename() returns None.
-    if instream.filename() is None:
-        filenames = instream._files
-    else:
-        filenames = [instream.filename()]
-    # When reading from sys.stdin, filename() is "-"
-    total = None if filenames[0] == "-" else sum(line_count(filename) for filename in filenames)
-
-    for epd in tqdm(instream, total=total):
-        fen = epd.split(';')[0]
-        annotations = dict(token.split(' ', 1) for token in epd.strip().split(';')[1:])
-        for k, v in inferred_annotations.items():
-            annotations[k] = v(fen, annotations)
-        if not filter(annotations, min, max, values):
+    is_filtered = compile_filter(min, max, values, inferred_annotations)
+    for epd in instream:
+        if not is_filtered(InferredRecord(epd, inferred_annotations)):
             outstream.write(epd)
 
 
+# Compiled filter of a worker process, set up by init_worker.
+worker_filter = None
+
+
+def init_worker(min, max, values, piece_values):
+    global worker_filter
+    inferred_annotations = material_annotations(piece_values)
+    worker_filter = compile_filter(min, max, values, inferred_annotations), inferred_annotations
+
+
+def filter_chunk(lines):
+    is_filtered, inferred_annotations = worker_filter
+    return ''.join(epd for epd in lines if not is_filtered(InferredRecord(epd, inferred_annotations)))
+
+
+def filter_puzzles_parallel(instream, outstream, min, max, values, piece_values, jobs, chunk_size=10000):
+    """Filter chunks of lines in worker processes and write them in input order, with at most two chunks per worker in flight."""
+    lines = iter(instream)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(min, max, values, piece_values)) as executor:
+        pending = deque()
+        for chunk in iter(lambda: list(islice(lines, chunk_size)), []):
+            pending.append(executor.submit(filter_chunk, chunk))
+            # write finished chunks right away for downstream stages of a pipeline
+            while pending and (len(pending) >= 2 * jobs or pending[0].done()):
+                outstream.write(pending.popleft().result())
+                outstream.flush()
+        while pending:
+            outstream.write(pending.popleft().result())
+        outstream.flush()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('epd_files', nargs='*')
@@ -84,17 +130,19 @@ if __name__ == '__main__':
                         help='Set as comma separated list in key=value1,value2 pair. Repeat to add more options.')
     parser.add_argument('-p', '--piece-values', nargs='+', action='append', default=[],
                         help='Piece values mapping, e.g. P=1 N=3 B=3 R=5 Q=9')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to filter chunks of the input with')
+    parser.add_argument('--range', type=parse_range, help='only filter the lines start:end of the input, counting from 0')
+    parser.add_argument('--shard', type=parse_shard, help='only filter the i-th of N equally sized parts of the input, counting from 0, written as i/N')
     args = parser.parse_args()
+    if (args.range or args.shard) and (not args.epd_files or '-' in args.epd_files):
+        parser.error('--range and --shard require input files')
     try:
         piece_values_dict = {k.lower(): int(v) for k, v in (item.split('=') for sublist in args.piece_values for item in sublist)}
     except Exception as e:
         parser.error(f"Error parsing --piece-values: {e}")
 
-    inferred_annotations = {
-        'material': lambda fen, annotations: net_material(piece_values_dict, fen),
-        'finalmaterial': lambda fen, annotations: -final_net_material(piece_values_dict, fen, annotations),
-        'materialdiff': lambda fen, annotations: -final_net_material(piece_values_dict, fen, annotations) - net_material(piece_values_dict, fen),
-    }
-
-    with fileinput.input(args.epd_files) as instream:
-        filter_puzzles(instream, sys.stdout, dict(args.min), dict(args.max), dict(args.values), inferred_annotations)
+    instream = EpdReader(args.epd_files, args.range, args.shard, progress=True)
+    if args.jobs > 1:
+        filter_puzzles_parallel(instream, sys.stdout, dict(args.min), dict(args.max), dict(args.values), piece_values_dict, args.jobs)
+    else:
+        filter_puzzles(instream, sys.stdout, dict(args.min), dict(args.max), dict(args.values), material_annotations(piece_values_dict))
@@ -7,9 +7,14 @@ from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import pyffish as sf
 
+import positions
 import uci
 
 
+# Engines are kept warm across the batches handled by a worker process.
+engine_pool = uci.EnginePool()
+
+
 def generate_fens(engine, variant, min_depth, max_depth, add_move, required_pieces, fen_list=None):
     if variant not in sf.variants():
         raise Exception("Unsupported variant: {}".format(variant))
@@ -26,28 +31,28 @@ def generate_fens(engine, variant, min_depth, max_depth, add_move, required_piec
         start_fen = random.choice(fen_choices)
         engine.newgame()
         move_stack = []
-        while (sf.legal_moves(variant, start_fen, move_stack)
+        while (positions.legal_moves(variant, start_fen, move_stack)
                and not sf.is_optional_game_end(variant, start_fen, move_stack)[0]):
             engine.position(start_fen, move_stack)
-            bestmove, _ = engine.go(depth=random.randint(min_depth, max_depth))
+            bestmove, _ = engine.go(fields=(), history=False, depth=random.randint(min_depth, max_depth))
             move_stack.append(bestmove)
             if not add_move:
-                fen = sf.get_fen(variant, start_fen, move_stack)
+                fen = positions.get_fen(variant, start_fen, move_stack)
                 bestmove = None
             else:
-                fen = sf.get_fen(variant, start_fen, move_stack[:-1])
+                fen = positions.get_fen(variant, start_fen, move_stack[:-1])
             if (fen, bestmove) not in fens and (not required_pieces or any(p in fen.split(' ')[0].lower() for p in required_pieces.lower())):
                 fens.add((fen, bestmove))
                 yield fen, bestmove
 
 
 def generate_fens_worker(engine_path, ucioptions, variant, min_depth, max_depth, add_move, required_pieces, count, fen_list=None):
-    engine = uci.Engine([engine_path], ucioptions)
-    generator = generate_fens(engine, variant, min_depth, max_depth, add_move, required_pieces, fen_list)
-    results = []
-    for _ in range(count):
-        results.append(next(generator))
-    return results
+    with engine_pool.engine([engine_path], ucioptions, variant) as engine:
+        generator = generate_fens(engine, variant, min_depth, max_depth, add_move, required_pieces, fen_list)
+        results = []
+        for _ in range(count):
+            results.append(next(generator))
+        return results
 
 
 def write_fens_parallel(stream, engine_path, ucioptions, variant, count, min_depth, max_depth, add_move, required_pieces, workers, fen_list=None):
@@ -8,6 +8,8 @@ import json
 from tqdm import tqdm
 import pyffish as sf
 
+import positions
+
 GRANDS = ("xiangqi", "manchu", "grand", "grandhouse", "shako", "janggi")
 
 
@@ -49,7 +51,7 @@ def generate_fens(json_file, stream, variant, count):
                     start_fen = sf.start_fen(variant)
 
                 for i in range(1, len(moves)):
-                    fen = sf.get_fen(variant, start_fen, moves[:i], is960, sfen, show_promoted)
+                    fen = positions.get_fen(variant, start_fen, moves[:i], is960, sfen, show_promoted)
                     stream.write(
                         "{};variant {};site https://www.pychess.org/{}{}".format(
                             fen, variant, _id, os.linesep
@@ -8,6 +8,8 @@ import pyffish as sf
 import cshogi
 import cshogi.KIF
 
+from epdfile import EpdRecord
+
 
 def get_board_dimensions(variant):
     """Get board dimensions for a shogi variant."""
@@ -82,13 +84,9 @@ def is_shogi_variant(variant):
 def epd_to_kif(epd_stream, kif_stream):
     """Convert EPD puzzle format to KIF format."""
     for epd in epd_stream:
-        tokens = epd.strip().split(';')
-        if not tokens:
-            continue
-            
-        fen = tokens[0]
-        annotations = dict(token.strip().split(' ', 1) for token in tokens[1:] if ' ' in token.strip())
-        variant = annotations.get('variant', '')
+        record = EpdRecord(epd)
+        fen = record.fen
+        variant = record.get('variant', '')
 
         # Only process shogi variants for KIF export
         if not is_shogi_variant(variant):
@@ -99,7 +97,7 @@ def epd_to_kif(epd_stream, kif_stream):
             raise Exception("Unsupported variant: {}".format(variant))
 
         # Get the move sequence from pv annotation
-        moves = annotations.get('pv', '').split(',')
+        moves = record.get('pv', '').split(',')
         if not moves or moves == ['']:
             print(f"No moves found in puzzle, skipping", file=sys.stderr)
             continue
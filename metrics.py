@@ -0,0 +1,82 @@
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+
+# Stage timings are only recorded when enabled, e.g., by puzzler.py --timings, to keep the hot paths free of overhead.
+enabled = False
+
+STAGES = ('pyffish', 'search', 'engine', 'parse', 'themes', 'rating', 'output')
+
+
+@contextmanager
+def timed(stats, stage):
+    """Add the wall and CPU time of the block to the <stage>_time and <stage>_cpu counts of stats, if enabled."""
+    if not enabled:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        stats[stage + '_time'] += time.perf_counter() - wall
+        stats[stage + '_cpu'] += time.process_time() - cpu
+
+
+def snapshot(stats, elapsed):
+    """Return the metrics of a run from its accumulated stats and its elapsed wall time."""
+    positions = stats['positions']
+    nodes = stats['nodes'] + stats['screen_nodes']
+    metrics = {
+        'elapsed': round(elapsed, 3),
+        'positions': positions,
+        'puzzles': stats['puzzles'],
+        'timeouts': stats['timeouts'],
+        'restarts': stats['restarts'],
+        'positions_per_second': round(positions / elapsed, 3) if elapsed else 0,
+        'yield': round(stats['puzzles'] / positions, 4) if positions else 0,
+        'searches': stats['searches'] + stats['screen_searches'],
+        'nodes': nodes,
+        'nps': round(nodes / stats['engine_time']) if stats['engine_time'] else 0,
+        'stages': {stage: {'time': round(stats[stage + '_time'], 3), 'cpu': round(stats[stage + '_cpu'], 3)}
+                   for stage in STAGES if stage + '_time' in stats},
+    }
+    return metrics
+
+
+class MetricsWriter():
+    """Periodically appends the metrics of a run as a JSON line to a file, and once more when closed."""
+
+    def __init__(self, path, interval=10):
+        self.file = open(path, 'a') if path else None
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_dump = self.start
+
+    def update(self, stats):
+        now = time.perf_counter()
+        if self.file and now - self.last_dump >= self.interval:
+            self.dump(stats, now)
+
+    def dump(self, stats, now=None):
+        now = now or time.perf_counter()
+        self.file.write(json.dumps(snapshot(stats, now - self.start)) + '\n')
+        self.file.flush()
+        self.last_dump = now
+
+    def close(self, stats):
+        """Write the final metrics and return them."""
+        if self.file:
+            self.dump(stats)
+            self.file.close()
+        return snapshot(stats, time.perf_counter() - self.start)
+
+
+def report(metrics, stream=sys.stderr):
+    """Write a summary of the metrics of a run."""
+    stream.write('Positions per second: {:.2f}, puzzle yield: {:.1%}, timeouts: {}, nodes per second: {}\n'.format(
+        metrics['positions_per_second'], metrics['yield'], metrics['timeouts'], metrics['nps']))
+    for stage, times in metrics['stages'].items():
+        stream.write('{:<10} wall {:>10.3f}s  cpu {:>10.3f}s  {:>8.3f}ms/position\n'.format(
+            stage, times['time'], times['cpu'], 1000 * times['time'] / max(metrics['positions'], 1)))
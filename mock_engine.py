@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Fake UCI engine for tests and benchmarks, so that the scripts can be run without Fairy-Stockfish.
+
+By default, searches are synthetic: the moves and scores of each position are derived from a hash of the position,
+so that results are deterministic, and a configurable share of positions has a winning or mating best line.
+With the Replay option, the output of a real engine, e.g., captured from a log, is instead replayed search by search.
+The Latency option adds a delay per depth to simulate engine time.
+
+If the environment variable MOCK_ENGINE_LOG is set, the time spent per search is appended to that file,
+so that engine time can be told apart from the overhead of the calling script.
+"""
+import os
+import sys
+import threading
+import time
+import zlib
+
+import pyffish as sf
+
+
+OPTIONS = (
+    ('UCI_Variant', 'string', 'chess'),
+    ('VariantPath', 'string', '<empty>'),
+    ('MultiPV', 'spin', 1),
+    ('Latency', 'spin', 0),
+    ('WinRate', 'spin', 20),
+    ('MateRate', 'spin', 5),
+    ('Seed', 'spin', 0),
+    ('Replay', 'string', '<empty>'),
+)
+MAX_DEPTH = 245
+
+
+class MockEngine():
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.lock = threading.Lock()
+        self.options = {name.lower(): default for name, _, default in OPTIONS}
+        self.fen = None
+        self.moves = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.replay = None
+        self.replay_index = 0
+        self.legal = {}
+        self.log = os.environ.get('MOCK_ENGINE_LOG')
+
+    def write(self, *lines):
+        with self.lock:
+            self.out.write(''.join(line + '\n' for line in lines))
+            self.out.flush()
+
+    def setoption(self, name, value):
+        name = name.lower()
+        if name not in self.options:
+            return
+        if isinstance(self.options[name], int):
+            value = int(value)
+        self.options[name] = value
+        if name == 'variantpath' and value not in ('', '<empty>'):
+            with open(value) as f:
+                sf.load_variant_config(f.read())
+        elif name == 'replay':
+            self.replay = self.load_replay(value) if value not in ('', '<empty>') else None
+            self.replay_index = 0
+
+    @staticmethod
+    def load_replay(path):
+        """Split engine output into the output lines of its searches, each ending with a best move."""
+        searches, lines = [], []
+        with open(path) as f:
+            for line in f:
+                if line.startswith('info ') or line.startswith('bestmove'):
+                    lines.append(line.rstrip('\n'))
+                if line.startswith('bestmove'):
+                    searches.append(lines)
+                    lines = []
+        if not searches:
+            raise Exception('No searches found in {}'.format(path))
+        return searches
+
+    def position(self, tokens):
+        variant = self.options['uci_variant']
+        if tokens[1] == 'startpos':
+            self.fen = sf.start_fen(variant)
+            rest = tokens[2:]
+        else:
+            end = tokens.index('moves') if 'moves' in tokens else len(tokens)
+            self.fen = ' '.join(tokens[2:end])
+            rest = tokens[end:]
+        self.moves = rest[1:]
+
+    def legal_moves(self, moves):
+        key = (self.options['uci_variant'], self.fen, tuple(moves))
+        if key not in self.legal:
+            if len(self.legal) > 10000:
+                self.legal.clear()
+            self.legal[key] = sorted(sf.legal_moves(self.options['uci_variant'], self.fen, moves))
+        return self.legal[key]
+
+    def wait(self, deadline, depth, max_depth):
+        """Sleep for the latency of a depth and return whether the search should continue."""
+        latency = self.options['latency'] / 1000
+        if latency and self.stop_event.wait(latency):
+            return False
+        if deadline and time.monotonic() >= deadline:
+            return False
+        return depth < max_depth and not self.stop_event.is_set()
+
+    def search(self, limits):
+        """Return the output lines of a synthetic search."""
+        variant = self.options['uci_variant']
+        legal = self.legal_moves(self.moves)
+        if not legal:
+            in_check = sf.gives_check(variant, self.fen, self.moves)
+            return ['info depth 0 score {}'.format('mate 0' if in_check else 'cp 0'), 'bestmove (none)']
+        h = zlib.crc32('{} {} {}'.format(self.fen, ' '.join(self.moves), self.options['seed']).encode())
+        kind = h % 100
+        multipv = min(self.options['multipv'], len(legal))
+        # the best move also depends on the depth limit, so that games between searches of varying depth differ
+        best = legal[(h + int(limits.get('depth', 0))) % len(legal)]
+        alternatives = [move for move in legal if move != best]
+        replies = self.legal_moves(self.moves + [best])
+        best_pv = [best] + ([replies[(h >> 8) % len(replies)]] if replies else [])
+
+        max_depth = int(limits.get('depth', MAX_DEPTH if 'infinite' in limits or 'movetime' in limits else 5))
+        deadline = time.monotonic() + int(limits['movetime']) / 1000 if 'movetime' in limits else None
+        output = []
+        depth = 1
+        while True:
+            for m in range(1, multipv + 1):
+                pv = best_pv if m == 1 else [alternatives[(h + m - 2) % len(alternatives)]]
+                if m == 1 and kind < self.options['materate']:
+                    score = 'mate {}'.format(1 + (h >> 16) % 5)
+                else:
+                    score = 'cp {}'.format((600 if m == 1 and kind < self.options['materate'] + self.options['winrate'] else 0)
+                                           + (h >> 4) % 50 - 10 * m + (h >> depth) % 7)
+                output.append('info depth {0} seldepth {0} multipv {1} score {2} nodes {3} nps 1000000 time {4} pv {5}'.format(
+                              depth, m, score, 1000 * depth, depth, ' '.join(pv)))
+            if not self.wait(deadline, depth, max_depth):
+                break
+            depth += 1
+        # infinite searches only return once stopped, like real engines
+        if 'infinite' in limits:
+            self.stop_event.wait()
+        return output + ['bestmove {}'.format(best)]
+
+    def go(self, tokens):
+        start = time.perf_counter()
+        limits = dict(zip(tokens[1::2], tokens[2::2]))
+        if 'infinite' in tokens:
+            limits['infinite'] = ''
+        if self.replay:
+            output = self.replay[self.replay_index % len(self.replay)]
+            self.replay_index += 1
+            # replay depth by depth, the best move is also sent when stopped
+            depths = {}
+            for line in output[:-1]:
+                tokens = line.split()
+                depths.setdefault(tokens[tokens.index('depth') + 1] if 'depth' in tokens else None, []).append(line)
+            for lines in depths.values():
+                self.write(*lines)
+                if not self.wait(None, 0, 1):
+                    break
+            output = output[-1:]
+        else:
+            output = self.search(limits)
+        if self.log:
+            with open(self.log, 'a') as f:
+                f.write('{:.6f}\n'.format(time.perf_counter() - start))
+        self.write(*output)
+
+    def join(self):
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self, instream=sys.stdin):
+        for line in instream:
+            tokens = line.split()
+            if not tokens:
+                continue
+            command = tokens[0]
+            if command == 'uci':
+                self.write('id name MockEngine', 'id author chess-variant-puzzler',
+                           *('option name {} type {} default {}'.format(name, kind, default) for name, kind, default in OPTIONS), 'uciok')
+            elif command == 'isready':
+                self.write('readyok')
+            elif command == 'setoption' and 'name' in tokens:
+                i = tokens.index('name')
+                j = tokens.index('value') if 'value' in tokens else len(tokens)
+                self.join()
+                self.setoption(' '.join(tokens[i + 1:j]), ' '.join(tokens[j + 1:]))
+            elif command == 'ucinewgame':
+                self.join()
+            elif command == 'position':
+                self.join()
+                self.position(tokens)
+            elif command == 'go':
+                self.join()
+                self.stop_event.clear()
+                self.thread = threading.Thread(target=self.go, args=(tokens,), daemon=True)
+                self.thread.start()
+            elif command == 'stop':
+                self.stop_event.set()
+            elif command == 'quit':
+                break
+        self.stop_event.set()
+        self.join()
+
+
+if __name__ == '__main__':
+    MockEngine().run()
@@ -5,6 +5,8 @@ import sys
 
 import pyffish as sf
 
+from epdfile import EpdRecord
+
 
 PGN_HEADER = """
 [Event "{}"]
@@ -16,27 +18,41 @@ PGN_HEADER = """
 """
 
 
-def epd_to_pgn(epd_stream, pgn_stream):
+def puzzle_to_pgn(record):
+    """Return the PGN of a puzzle, numbering the moves in a single pass from the start position."""
+    fen = record.fen
+    variant = record['variant']
+
+    if variant not in sf.variants():
+        raise Exception("Unsupported variant: {}".format(variant))
+
+    site = record.get('site', 'https://github.com/ianfab/Fairy-Stockfish')
+    chunks = [PGN_HEADER.format(record.get('type'), site, variant.capitalize(), fen)]
+    moves = record.get('pv', '').split(',')
+    san_moves = sf.get_san_moves(variant, fen, moves)
+    # the normalized start position always has a side to move and a move number
+    start_fen = sf.get_fen(variant, fen, []).split(' ')
+    whiteToMove = start_fen[1] == 'w'
+    fullmove = int(start_fen[-1])
+    for i, san_move in enumerate(san_moves):
+        movenum = '{}. '.format(fullmove) if whiteToMove else '{}... '.format(fullmove) if i == 0 else ''
+        chunks.append('{}{} '.format(movenum, san_move))
+        if not whiteToMove:
+            fullmove += 1
+        whiteToMove = not whiteToMove
+    chunks.append('*{}'.format(os.linesep))
+    return ''.join(chunks)
+
+
+def epd_to_pgn(epd_stream, pgn_stream, chunk_size=1000):
+    """Convert EPD lines to PGN, writing the PGNs of chunk_size puzzles at once."""
+    chunk = []
     for epd in epd_stream:
-        tokens = epd.strip().split(';')
-        fen = tokens[0]
-        annotations = dict(token.split(' ', 1) for token in tokens[1:])
-        variant = annotations['variant']
-
-        if variant not in sf.variants():
-            raise Exception("Unsupported variant: {}".format(variant))
-
-        site = annotations.get('site', 'https://github.com/ianfab/Fairy-Stockfish')
-        pgn_stream.write(PGN_HEADER.format(annotations.get('type'), site, variant.capitalize(), fen))
-        moves = annotations.get('pv', '').split(',')
-        san_moves = sf.get_san_moves(variant, fen, moves)
-        for i, san_move in enumerate(san_moves):
-            cur_fen = sf.get_fen(variant, fen, moves[:i])
-            fullmove = cur_fen.split(' ')[-1]
-            whiteToMove = cur_fen.split(' ')[1] == 'w'
-            movenum = '{}. '.format(fullmove) if whiteToMove else '{}... '.format(fullmove) if i == 0 else ''
-            pgn_stream.write('{}{} '.format(movenum, san_move))
-        pgn_stream.write('*{}'.format(os.linesep))
+        chunk.append(puzzle_to_pgn(EpdRecord(epd)))
+        if len(chunk) >= chunk_size:
+            pgn_stream.write(''.join(chunk))
+            chunk = []
+    pgn_stream.write(''.join(chunk))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+import pyffish as sf
+
+
+class PositionCache():
+    """
+    Memoizes FENs, legal moves and check status of positions given by variant, start FEN and moves.
+    A position is derived from the longest recently seen prefix of its moves, so that extending a line
+    by a few moves does not replay the whole line, and repeated queries do not call pyffish at all.
+    Positions are stored as FENs with promoted pieces marked, so that derived positions are exact,
+    and the least recently used positions are evicted once max_entries is exceeded.
+    """
+
+    # number of move prefixes searched for a known parent position
+    MAX_STEPS = 8
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def _entry(self, variant, fen, moves, chess960):
+        moves = tuple(moves)
+        key = (variant, fen, moves, chess960)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        parent_fen, i = fen, 0
+        for i in range(len(moves) - 1, max(len(moves) - self.MAX_STEPS, 0) - 1, -1):
+            parent = self.entries.get((variant, fen, moves[:i], chess960))
+            if parent is not None:
+                parent_fen = parent['fen']
+                break
+        else:
+            i = 0
+        # FEN keeps promoted piece markers, e.g., for captures in crazyhouse
+        entry = {'fen': sf.get_fen(variant, parent_fen, list(moves[i:]), chess960, False, True)}
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def get_fen(self, variant, fen, moves, chess960=False, sfen=False, show_promoted=False):
+        position_fen = self._entry(variant, fen, moves, chess960)['fen']
+        if sfen or (not show_promoted and '~' in position_fen):
+            return sf.get_fen(variant, position_fen, [], chess960, sfen, show_promoted)
+        return position_fen
+
+    def legal_moves(self, variant, fen, moves, chess960=False):
+        entry = self._entry(variant, fen, moves, chess960)
+        if 'legal_moves' not in entry:
+            entry['legal_moves'] = sf.legal_moves(variant, entry['fen'], [], chess960)
+        return entry['legal_moves']
+
+    def gives_check(self, variant, fen, moves, chess960=False):
+        entry = self._entry(variant, fen, moves, chess960)
+        if 'gives_check' not in entry:
+            entry['gives_check'] = sf.gives_check(variant, entry['fen'], [], chess960)
+        return entry['gives_check']
+
+
+# Positions are shared within a process, e.g., between the plies of a puzzler line.
+cache = PositionCache()
+get_fen = cache.get_fen
+legal_moves = cache.legal_moves
+gives_check = cache.gives_check
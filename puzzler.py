@@ -1,23 +1,26 @@
 import argparse
-import fileinput
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from contextlib import contextmanager, nullcontext
 from functools import partial
+from itertools import islice
+import json
 import math
+import os
 import sys
-import threading
 import time
 from tqdm import tqdm
 import pyffish as sf
 import numpy as np
 
+from analysis import AnalysisWriter, read_analyses
+from cache import AnalysisCache, engine_key
+from epdfile import EpdReader, EpdRecord, parse_range, parse_shard
+import metrics
+import positions
 import uci
 
 
-def line_count(filename):
-    f = open(filename, 'rb')
-    bufgen = iter(partial(f.raw.read, 1024*1024), b'')
-    return sum(buf.count(b'\n') for buf in bufgen)
-
-
 def move(info_line):
     return info_line['pv'][0] if 'pv' in info_line else None
 
@@ -35,10 +38,6 @@ def mate_distance(info_line):
     return int(info_line['score'][1])
 
 
-def has_cp(info_line, score=0):
-    return info_line['score'][0] == 'cp' and int(info_line['score'][1]) > score
-
-
 def sigmoid(x):
     if x >= 0:
         z = math.exp(-x)
@@ -55,140 +54,267 @@ def value(info_line, scale):
         return sigmoid(float(info_line['score'][1]) / scale)
 
 
-def is_shortest_win(candidate, first_alt, mate_distance_ratio):
-    return is_mate(candidate) and (not is_mate(first_alt) or mate_distance(first_alt) >= mate_distance(candidate) * mate_distance_ratio)
+def score_arrays(lines):
+    """Return whether the scores of the info lines are mate scores, and their centipawns or mate distances, as arrays."""
+    mates = np.array([line['score'][0] == 'mate' for line in lines], dtype=bool)
+    scores = np.array([float(line['score'][1]) for line in lines], dtype=float)
+    return mates, scores
 
 
-def get_puzzle_theme(multipv_info, win_threshold, unclear_threshold, mate_distance_ratio):
+def values(mates, scores, scale):
+    """Vectorized value() of score arrays."""
+    z = np.exp(-np.abs(scores) / scale)
+    return np.where(mates, scores >= 0, np.where(scores >= 0, 1 / (1 + z), z / (1 + z)))
+
+
+def puzzle_themes(mates, scores, win_threshold, unclear_threshold, mate_distance_ratio):
+    """
+    Return the puzzle theme, or None, of each final depth of a search
+    given by score arrays of shape (searches, 2) of its two best lines, see score_arrays.
+    """
     scale = win_threshold * 0.7
     min_diff = sigmoid(win_threshold / scale) - sigmoid(unclear_threshold / scale)
 
-    candidate = multipv_info[0]
-    first_alt = multipv_info[1]
-
-    if (    value(candidate, scale) - value(first_alt, scale) >= min_diff
-        or (mate_distance_ratio and is_shortest_win(candidate, first_alt, mate_distance_ratio))):
-        if is_mate(candidate):
-            return 'mate'
-        elif has_cp(candidate, win_threshold):
-            return 'winning'
-        elif has_cp(candidate, unclear_threshold):
-            return 'turnaround'
-        else:
-            return 'defensive'
+    candidate_values, first_alt_values = values(mates, scores, scale).T
+    (candidate_mates, first_alt_mates), (candidate_scores, first_alt_scores) = mates.T, scores.T
+    candidate_wins = candidate_mates & (candidate_scores > 0)
 
-    return None
+    is_puzzle = candidate_values - first_alt_values >= min_diff
+    if mate_distance_ratio:
+        # shortest win
+        is_puzzle |= candidate_wins & (~(first_alt_mates & (first_alt_scores > 0)) | (first_alt_scores >= candidate_scores * mate_distance_ratio))
+    themes = np.select([~is_puzzle, candidate_wins, ~candidate_mates & (candidate_scores > win_threshold), ~candidate_mates & (candidate_scores > unclear_threshold)],
+                       [0, 1, 2, 3], 4)
+    return [(None, 'mate', 'winning', 'turnaround', 'defensive')[theme] for theme in themes]
+
+
+def get_puzzle_themes(multipv_infos, win_threshold, unclear_threshold, mate_distance_ratio):
+    """Return the puzzle theme, or None, of each of the given final depth multipv infos."""
+    mates, scores = score_arrays([line for multipv_info in multipv_infos for line in multipv_info[:2]])
+    return puzzle_themes(mates.reshape(-1, 2), scores.reshape(-1, 2), win_threshold, unclear_threshold, mate_distance_ratio)
 
-def timeout_monitor(engine: uci.Engine, timeout, count_time: threading.Event):
-    while True:
-        count_time.wait()
-        start_time = time.time()
-        lock = threading.Lock()
-        while time.time() < start_time + timeout:
-            if not count_time.is_set():
-                break
-        else:
-            with lock:
-                engine.write('stop\n')
-                count_time.clear()
-        
 
-def get_puzzle(variant, fen, moves, engine, depth, win_threshold, unclear_threshold, mate_distance_ratio, count_time: threading.Event):
-    if len(sf.legal_moves(variant, fen, moves)) <= 2:
+def get_puzzle_theme(multipv_info, win_threshold, unclear_threshold, mate_distance_ratio):
+    return get_puzzle_themes([multipv_info], win_threshold, unclear_threshold, mate_distance_ratio)[0]
+
+
+def search_nodes(info):
+    return max((line.get('nodes', 0) for line in info[-1]), default=0) if info else 0
+
+
+# Info fields used for rating puzzles, and for screening searches, which only need the final depth.
+SEARCH_FIELDS = ('score', 'pv', 'nodes')
+SCREEN_FIELDS = ('score', 'nodes')
+
+
+def search(engine, variant, fen, moves, depth, watchdog: uci.Watchdog, cache=None, stats=None, history=True):
+    """
+    Return the infos of a search to the given depth and whether they were taken from the cache.
+    Without history, only the infos of the final depth are needed. Cached analyses are always complete.
+    """
+    if cache:
+        key = engine_key(engine.id, engine.options)
+        info = cache.get(key, variant, fen, moves, engine.options.get('multipv'), depth)
+        if info is not None:
+            stats['cache_hits'] += 1
+            return info, True
+        stats['cache_misses'] += 1
+    if watchdog.timed_out:
+        raise TimeoutError
+    with metrics.timed(stats, 'search'):
+        engine.position(fen, moves)
+        if cache:
+            _, info = engine.go(depth=depth)
+        else:
+            _, info = engine.go(fields=SEARCH_FIELDS if history else SCREEN_FIELDS, history=history, depth=depth)
+    if watchdog.timed_out:
+        raise TimeoutError
+    if cache and info:
+        cache.put(key, variant, fen, moves, engine.options.get('multipv'), depth, info)
+    return info, False
+
+
+def get_puzzle(variant, fen, moves, engine, depth, win_threshold, unclear_threshold, mate_distance_ratio, watchdog: uci.Watchdog, new_game=True,
+               screen_depths=(), cache=None, stats=None):
+    stats = stats if stats is not None else Counter()
+    with metrics.timed(stats, 'pyffish'):
+        legal_moves = positions.legal_moves(variant, fen, moves)
+    if len(legal_moves) <= 2:
         return None, None
-    engine.setoption('UCI_Variant', variant)
-    engine.newgame()
-    engine.position(fen, moves)
-    _, info = engine.go(depth=depth)
-    if count_time.is_set():
+    if new_game:
+        # changing the variant can be expensive, e.g., due to loading of NNUE networks
+        if engine.options.get('UCI_Variant') != variant:
+            engine.setoption('UCI_Variant', variant)
+            stats['variant_switches'] += 1
+        engine.newgame()
+    # Shallow screening searches first, only continue deeper while there still is a candidate gap.
+    for screen_depth in screen_depths:
+        info, cached = search(engine, variant, fen, moves, screen_depth, watchdog, cache, stats, history=False)
+        if not cached:
+            stats['screen_searches'] += 1
+            stats['screen_nodes'] += search_nodes(info)
         if not info or not isinstance(info[-1], list) or len(info[-1]) < 2:
-            sys.stderr.write(f"Warning: No valid multipv info for {fen} after {depth} depth search.\n")
-            sys.stderr.write(f"{info}\n")
-            return None, info
+            stats['screened_out'] += 1
+            return None, None
+        with metrics.timed(stats, 'themes'):
+            theme = get_puzzle_theme(info[-1], win_threshold, unclear_threshold, mate_distance_ratio)
+        if not theme:
+            stats['screened_out'] += 1
+            return None, None
+    info, cached = search(engine, variant, fen, moves, depth, watchdog, cache, stats)
+    if not cached:
+        stats['searches'] += 1
+        stats['nodes'] += search_nodes(info)
+        if not new_game:
+            stats['continuation_searches'] += 1
+            stats['continuation_nodes'] += search_nodes(info)
+    if not info or not isinstance(info[-1], list) or len(info[-1]) < 2:
+        sys.stderr.write(f"Warning: No valid multipv info for {fen} after {depth} depth search.\n")
+        sys.stderr.write(f"{info}\n")
+        return None, info
+    with metrics.timed(stats, 'themes'):
         theme = get_puzzle_theme(info[-1], win_threshold, unclear_threshold, mate_distance_ratio)
-        return theme, info
-    raise TimeoutError
+    return theme, info
+
+
+def rate_searches(mates, scores, is_bestmove, lengths, win_threshold):
+    """
+    Rate many searches at once, see rate_puzzle. The searches are given by score arrays of shape (depths, 2)
+    of the two best lines of all their depths concatenated, see score_arrays, by whether the best line of each depth
+    starts with the best move of the final depth, and by the number of depths per search.
+    """
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ends = starts + lengths - 1
+    v = values(mates, scores, win_threshold)
+    steps = np.abs(np.diff(v, axis=0, prepend=v[:1]))
+    steps[starts] = 0
+    deviations = np.abs(v - np.repeat(v[ends], lengths, axis=0))
+    volatility, volatility2 = np.add.reduceat(steps, starts).T / lengths
+    accuracy, accuracy2 = np.add.reduceat(deviations, starts).T / lengths
+    quality = np.add.reduceat(np.where(is_bestmove, np.abs(v[:, 0] - v[:, 1]), 0), starts) / lengths
+
+    both_win = (mates[ends] & (scores[ends] > 0)).all(axis=1)
+    mate_distance_fraction = np.divide(scores[ends, 0], scores[ends, 1], out=np.zeros(len(lengths)), where=both_win)
+
+    return list(zip(volatility, volatility2, accuracy, accuracy2, quality, mate_distance_fraction))
+
+
+def rate_puzzles(infos, win_threshold):
+    """Rate the per-depth multipv infos of many searches at once, see rate_puzzle."""
+    mates, scores = score_arrays([line for info in infos for multiinf in info for line in multiinf[:2]])
+    is_bestmove = np.array([move(multiinf[0]) == move(info[-1][0]) for info in infos for multiinf in info], dtype=bool)
+    lengths = np.array([len(info) for info in infos])
+    return rate_searches(mates.reshape(-1, 2), scores.reshape(-1, 2), is_bestmove, lengths, win_threshold)
 
 
 def rate_puzzle(info, win_threshold):
-    bestmove = move(info[-1][0])
-    bestscore = value(info[-1][0], win_threshold)
-    bestscore2 = value(info[-1][1], win_threshold)
-    quality = 0
-    last_score = None
-    last_second_score = None
-    volatility = 0
-    volatility2 = 0
-    accuracy = 0
-    accuracy2 = 0
-    for multiinf in info:
-        v0 = value(multiinf[0], win_threshold)
-        v1 = value(multiinf[1], win_threshold)
-        if move(multiinf[0]) == bestmove:
-            quality += abs(v0 - v1)
-        accuracy += abs(v0 - bestscore)
-        accuracy2 += abs(v1 - bestscore2)
-        if last_score is not None:
-            volatility += abs(v0 - last_score)
-            volatility2 += abs(v1 - last_second_score)
-        last_score = v0
-        last_second_score = v1
-    if is_mate(multiinf[0]) and is_mate(multiinf[1]):
-        mate_distance_fraction = mate_distance(multiinf[0]) / mate_distance(multiinf[1])
-    else:
-        mate_distance_fraction = 0
+    """Return volatility, volatility2, accuracy, accuracy2, quality and mate distance fraction of the per-depth multipv infos of a search."""
+    return rate_puzzles([info], win_threshold)[0]
 
-    return volatility / len(info), volatility2 / len(info),  accuracy / len(info),  accuracy2 / len(info), quality / len(info), mate_distance_fraction
 
+def ply_analysis(info):
+    """
+    Return the analysis of a ply needed to rate it, independent of any thresholds: the score arrays of the two best lines per depth,
+    whether the best line of each depth starts with the final best move, and the first two moves of the final best line.
+    """
+    mates, scores = score_arrays([line for multiinf in info for line in multiinf[:2]])
+    is_bestmove = np.array([move(multiinf[0]) == move(info[-1][0]) for multiinf in info], dtype=bool)
+    return mates.reshape(-1, 2), scores.reshape(-1, 2), is_bestmove, info[-1][0]['pv'][:2]
 
-def generate_puzzles(instream, outstream, engine, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, timeout):
-    if failed_file:
-        ff = open(failed_file, "w")
 
-    # Before the first line has been read, filename() returns None.
-    if instream.filename() is None:
-        filename = instream._files[0]
-    else:
-        filename = instream.filename()
-
-    # When reading from sys.stdin, filename() is "-"
-    total = None if (filename == "-") else line_count(filename)
-
-    count_time = threading.Event()
-    monitor_thread = threading.Thread(target=timeout_monitor, daemon=True, args=[engine, timeout, count_time])
-    monitor_thread.start()
-    
-    
-    for i, epd in enumerate(tqdm(instream, total=total)):
-        tokens = epd.strip().split(';')
-        fen = tokens[0]
-        annotations = dict(token.split(' ', 1) for token in tokens[1:])
-        current_variant = annotations.get('variant', variant)
-        if not current_variant:
-            raise Exception('Variant neither provided in EPD nor as argument')
-        pv = []
-        if 'sm' in annotations and annotations['sm'] in sf.legal_moves(current_variant, fen, []):
-            pv.append(annotations['sm'])
-        stm_index = len(pv)
-        evals = []
-        qualities = []
-        volatilities = []
-        volatilities2 = []
-        accuracies = []
-        accuracies2 = []
-        mate_distance_fractions = []
-        types = []
-        
-        is_timed_out = False	
-        count_time.set()
-        while True:	
-            try:
-                # only apply mate distance ratio once clean distance is reached
-                effective_mate_distance_ratio = mate_distance_ratio if (len(pv) - stm_index) / 2 >= clean_distance else 0
-                puzzle_type, info = get_puzzle(current_variant, fen, pv, engine, depth, win_threshold, unclear_threshold, effective_mate_distance_ratio, count_time)
-            except TimeoutError:
-                is_timed_out = True
+def rate_plies(plies, win_threshold):
+    """Rate the analyses of many plies at once, see ply_analysis and rate_puzzle."""
+    return rate_searches(np.concatenate([ply[0] for ply in plies]), np.concatenate([ply[1] for ply in plies]),
+                         np.concatenate([ply[2] for ply in plies]), np.array([len(ply[2]) for ply in plies]), win_threshold)
+
+
+def format_score(mate, score):
+    return ('#' if mate else '') + str(int(score))
+
+
+def format_puzzle(record: EpdRecord, variant, pv, stm_index, types, plies, ratings, win_threshold):
+    """Return the puzzle EPD line of a line given the types, analyses and ratings of its puzzle plies."""
+    fen = record.fen
+    is_tsume_puzzle = types and types[0] == 'mate'
+    if is_tsume_puzzle:
+        for i in range(stm_index, len(pv), 2):
+            moves_to_check = pv[:i+1]
+            is_check = positions.gives_check(variant, fen, moves_to_check)
+            if not is_check:
+                is_tsume_puzzle = False
                 break
+
+    volatilities, volatilities2, accuracies, accuracies2, qualities, mate_distance_fractions = zip(*ratings)
+    eval_mates = np.array([ply[0][-1, 0] for ply in plies])
+    eval_scores = np.array([ply[1][-1, 0] for ply in plies])
+    std = np.std(values(eval_mates, eval_scores, win_threshold))
+    difficulty = 4 * volatilities[0] + 2 * std + accuracies[0]
+    content = len(pv) - stm_index - 40 * volatilities2[0]
+    total_quality = sum(qualities) / len(qualities)
+    # output
+    record['variant'] = variant
+    if stm_index == 1:
+        record['sm'] = pv[0]
+    record['bm'] = pv[stm_index]
+    record['eval'] = format_score(eval_mates[0], eval_scores[0])
+    record['difficulty'] = '{:.3f}'.format(difficulty)
+    record['content'] = '{:.3f}'.format(content)
+    record['quality'] = '{:.3f}'.format(total_quality)
+    record['volatility'] = '{:.3f}'.format(volatilities[0])
+    record['volatility2'] = '{:.3f}'.format(volatilities2[0])
+    record['accuracy'] = '{:.3f}'.format(accuracies[0])
+    record['accuracy2'] = '{:.3f}'.format(accuracies2[0])
+    record['std'] = '{:.3f}'.format(std)
+    record['ambiguity'] = '{:.3f}'.format(max(mate_distance_fractions))
+    if is_tsume_puzzle:
+        record['tsume'] = 'true'
+    record['type'] = types[0]
+    record['pv'] = ','.join(pv)
+    return str(record)
+
+
+def parse_epd(epd, variant):
+    """Return the record, variant and the initial line of an EPD line, which contains the side to move's move if any."""
+    record = EpdRecord(epd)
+    current_variant = record.get('variant', variant)
+    if not current_variant:
+        raise Exception('Variant neither provided in EPD nor as argument')
+    pv = []
+    if 'sm' in record and record['sm'] in positions.legal_moves(current_variant, record.fen, []):
+        pv.append(record['sm'])
+    return record, current_variant, pv
+
+
+def find_puzzle(epd, engine, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, watchdog: uci.Watchdog,
+                keep_hash=False, screen_depths=(), cache=None, stats=None, analysis=None):
+    """
+    Analyze a single EPD line and return the annotated puzzle EPD line, or None if it contains no puzzle.
+    With keep_hash, the transposition table is only reset before the first search of the line,
+    so that continuation searches can reuse the analysis of the preceding plies.
+    Each ply is first searched at the screen_depths and discarded early if no candidate gap remains.
+    Searches found in the analysis cache are skipped.
+    The analyses of all plies searched to full depth, see ply_analysis, are appended to the analysis list if given.
+    """
+    stats = stats if stats is not None else Counter()
+    analysis = analysis if analysis is not None else []
+    with metrics.timed(stats, 'pyffish'):
+        record, current_variant, pv = parse_epd(epd, variant)
+    fen = record.fen
+    stm_index = len(pv)
+    plies = []
+    types = []
+
+    watchdog.start()
+    try:
+        while True:
+            # only apply mate distance ratio once clean distance is reached
+            effective_mate_distance_ratio = mate_distance_ratio if (len(pv) - stm_index) / 2 >= clean_distance else 0
+            puzzle_type, info = get_puzzle(current_variant, fen, pv, engine, depth, win_threshold, unclear_threshold, effective_mate_distance_ratio, watchdog,
+                                           new_game=not (keep_hash and len(pv) > stm_index), screen_depths=screen_depths, cache=cache, stats=stats)
+            with metrics.timed(stats, 'rating'):
+                ply = ply_analysis(info) if info and isinstance(info[-1], list) and all(len(multiinf) >= 2 for multiinf in info) else None
+            if ply:
+                analysis.append(ply)
             if not puzzle_type or (mate_only and puzzle_type != 'mate'):
                 # trim last opponent move
                 if pv:
@@ -197,77 +323,463 @@ def generate_puzzles(instream, outstream, engine, variant, depth, win_threshold,
                 if types and types[0] == 'mate':
                     types[0] = 'partial-mate'
                 break
-            evals.append(info[-1][0])
-            volatility, volatility2, accuracy, accuracy2, quality, mate_distance_fraction = rate_puzzle(info, win_threshold)
-            qualities.append(quality)
-            volatilities.append(volatility)
-            volatilities2.append(volatility2)
-            accuracies.append(accuracy)
-            accuracies2.append(accuracy2)
-            mate_distance_fractions.append(mate_distance_fraction)
+            plies.append(ply)
             types.append(puzzle_type)
             pv += info[-1][0]['pv'][:2]
             if len(info[-1][0]['pv']) < 2:
                 break
+    finally:
+        watchdog.cancel()
+
+    if len(pv) > stm_index and (not mate_only or (len(types) > 0 and types[0] == 'mate')):
+        with metrics.timed(stats, 'rating'):
+            return format_puzzle(record, current_variant, pv, stm_index, types, plies, rate_plies(plies, win_threshold), win_threshold)
+
+    return None
+
+
+def rescore_puzzles(records, variant, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, batch_size=10000):
+    """
+    Recompute the puzzles of (epd, plies) records of stored analyses, see find_puzzle, and yield (epd, puzzle) in order.
+    Lines can only be extended as far as they were analyzed, i.e., a ply without stored analysis ends the line.
+    Themes and ratings are computed for batches of records at once.
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        all_plies = [ply for _, plies in batch for ply in plies]
+        if all_plies:
+            final_mates = np.array([ply[0][-1] for ply in all_plies])
+            final_scores = np.array([ply[1][-1] for ply in all_plies])
+            themes = puzzle_themes(final_mates, final_scores, win_threshold, unclear_threshold, mate_distance_ratio)
+            themes_without_ratio = puzzle_themes(final_mates, final_scores, win_threshold, unclear_threshold, 0)
+
+        lines = []
+        index = 0
+        for epd, plies in batch:
+            record, current_variant, pv = parse_epd(epd, variant)
+            stm_index = len(pv)
+            types = []
+            for i, ply in enumerate(plies + [None]):
+                # only apply mate distance ratio once clean distance is reached
+                puzzle_type = None if ply is None else (themes if i >= clean_distance else themes_without_ratio)[index + i]
+                if not puzzle_type or (mate_only and puzzle_type != 'mate'):
+                    # trim last opponent move
+                    if pv:
+                        pv.pop()
+                    # re-tag incomplete mates
+                    if types and types[0] == 'mate':
+                        types[0] = 'partial-mate'
+                    break
+                types.append(puzzle_type)
+                pv += ply[3]
+                if len(ply[3]) < 2:
+                    break
+            index += len(plies)
+            is_puzzle = len(pv) > stm_index and (not mate_only or (len(types) > 0 and types[0] == 'mate'))
+            lines.append((epd, record, current_variant, pv, stm_index, types, plies[:len(types)] if is_puzzle else []))
+
+        puzzle_plies = [ply for line in lines for ply in line[-1]]
+        ratings = iter(rate_plies(puzzle_plies, win_threshold) if puzzle_plies else ())
+        for epd, record, current_variant, pv, stm_index, types, plies in lines:
+            if plies:
+                yield epd, format_puzzle(record, current_variant, pv, stm_index, types, plies, list(islice(ratings, len(plies))), win_threshold)
+            else:
+                yield epd, None
+
+
+def depth_schedule(schedule, depth=None):
+    """
+    Return the screening depths and the full search depth of a depth schedule. The depths need to be positive and increasing.
+    If given, depth is the full search depth, which the schedule may not exceed.
+    """
+    if schedule[0] < 1 or any(shallow >= deep for shallow, deep in zip(schedule, schedule[1:])):
+        raise ValueError('--depth-schedule needs to be increasing positive depths')
+    if depth is not None:
+        if schedule[-1] > depth:
+            raise ValueError('--depth-schedule can not exceed --depth')
+        if schedule[-1] < depth:
+            schedule = schedule + [depth]
+    return tuple(schedule[:-1]), schedule[-1]
+
+
+def input_total(instream):
+    """Return the number of bytes to read from the input, if known."""
+    return instream.total if isinstance(instream, EpdReader) else None
+
+
+def report_stats(stats):
+    sys.stderr.write('Positions: {}, puzzles: {}, timeouts: {}, engine restarts: {}\n'.format(
+        stats['positions'], stats['puzzles'], stats['timeouts'], stats['restarts']))
+    if stats['positions']:
+        sys.stderr.write('Time per position: {:.3f}s mean, {:.3f}s max\n'.format(stats['time'] / stats['positions'], stats['max_time']))
+    if stats['screen_searches']:
+        sys.stderr.write('Screening searches: {}, nodes: {}, screened out: {}\n'.format(stats['screen_searches'], stats['screen_nodes'], stats['screened_out']))
+    sys.stderr.write('Searches: {}, nodes: {}, variant switches: {}\n'.format(stats['searches'], stats['nodes'], stats['variant_switches']))
+    if stats['cache_hits'] or stats['cache_misses']:
+        sys.stderr.write('Cache hits: {}, misses: {}\n'.format(stats['cache_hits'], stats['cache_misses']))
+    if stats['continuation_searches']:
+        # continuations are only counted when the hash is kept
+        sys.stderr.write('Continuation searches: {}, nodes: {}\n'.format(stats['continuation_searches'], stats['continuation_nodes']))
+
+
+class Checkpoint():
+    """
+    Keeps track of the input position up to which all results have been written,
+    and periodically saves it together with the sizes of the output files.
+    Requires results to be written in input order.
+    """
+
+    def __init__(self, path, reader: EpdReader, interval=60):
+        self.path = path
+        self.reader = reader
+        self.interval = interval
+        self.state = {'files': reader.filenames, 'selection': reader.selection, 'file': 0, 'offset': 0, 'lines': 0, 'output': 0, 'failed': 0, 'analysis': 0}
+        self.resumed = False
+        self.positions = deque()
+        self.last_save = time.time()
+
+    def resume(self, output_file, failed_file, analysis_file=None):
+        """Load the checkpoint, if any, and truncate the output files to the checkpointed sizes."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            self.state = json.load(f)
+        if self.state['files'] != self.reader.filenames or self.state.get('selection') != self.reader.selection:
+            raise Exception('Checkpoint {} was created for different input files or lines: {} {}'.format(self.path, self.state['files'], self.state.get('selection')))
+        self.reader.seek((self.state['file'], self.state['offset']))
+        os.truncate(output_file, self.state['output'])
+        if failed_file:
+            os.truncate(failed_file, self.state['failed'])
+        if analysis_file:
+            os.truncate(analysis_file, self.state.get('analysis', 0))
+        self.resumed = True
+
+    def lines(self):
+        """Read the input starting from the checkpointed position, remembering the position after each line."""
+        for line in self.reader:
+            self.positions.append(self.reader.position)
+            yield line
+
+    def done(self, outstream, failed_stream, analysis_stream=None):
+        """Mark the next line as written and save the checkpoint if it is due."""
+        self.state['file'], self.state['offset'] = self.positions.popleft()
+        self.state['lines'] += 1
+        if time.time() - self.last_save >= self.interval:
+            self.save(outstream, failed_stream, analysis_stream)
+
+    def save(self, outstream, failed_stream, analysis_stream=None):
+        for stream in (outstream, failed_stream, analysis_stream):
+            if stream:
+                stream.flush()
+                os.fsync(stream.fileno())
+        self.state['output'] = outstream.tell()
+        self.state['failed'] = failed_stream.tell() if failed_stream else 0
+        self.state['analysis'] = analysis_stream.tell() if analysis_stream else 0
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.last_save = time.time()
+
+
+class ResultWriter():
+    """
+    Writes puzzles to the output, lines without a puzzle to the failed file and analyses to the analysis file, if any,
+    and marks the lines as done in the checkpoint, if any. The files are appended to when resuming from the checkpoint.
+    """
+
+    def __init__(self, outstream, failed_file=None, analysis_file=None, checkpoint=None):
+        append = bool(checkpoint and checkpoint.resumed)
+        self.outstream = outstream
+        self.failed_stream = open(failed_file, 'a' if append else 'w') if failed_file else None
+        self.analysis_writer = AnalysisWriter(analysis_file, append=append) if analysis_file else None
+        self.analysis_stream = self.analysis_writer.file if self.analysis_writer else None
+        self.checkpoint = checkpoint
+        self.count = 0
+
+    def write(self, epd, puzzle, timed_out, analysis):
+        """Write a result, timeouts are dropped."""
+        if puzzle:
+            self.outstream.write(puzzle)
+        elif self.failed_stream and not timed_out:
+            self.failed_stream.write(epd)
+        if self.analysis_writer and not timed_out:
+            self.analysis_writer.write(epd, analysis)
+        if self.checkpoint:
+            self.checkpoint.done(self.outstream, self.failed_stream, self.analysis_stream)
+        if self.count % 100 == 0:
+            self.outstream.flush()
+        self.count += 1
+
+    def close(self):
+        if self.checkpoint:
+            self.checkpoint.save(self.outstream, self.failed_stream, self.analysis_stream)
+        if self.failed_stream:
+            self.failed_stream.close()
+        if self.analysis_writer:
+            self.analysis_writer.close()
+
+
+def add_stats(total_stats, stats, puzzle, timed_out):
+    total_stats.update(stats)
+    total_stats['max_time'] = max(total_stats['max_time'], stats['time'])
+    total_stats['positions'] += 1
+    total_stats['puzzles'] += bool(puzzle)
+    total_stats['timeouts'] += timed_out
+
+
+def write_results(results, outstream, failed_file, total, checkpoint=None, analysis_file=None, metrics_writer=None):
+    """
+    Write (epd, puzzle, timed_out, stats, analysis) results using a ResultWriter and report the stats.
+    With a metrics writer, the metrics of the run are periodically dumped and summarized at the end.
+    """
+    writer = ResultWriter(outstream, failed_file, analysis_file, checkpoint)
+    initial = 0
+    if checkpoint:
+        total = checkpoint.reader.total
+        initial = checkpoint.reader.initial
+
+    total_stats = Counter()
+    pbar = tqdm(total=total, initial=initial, unit='B', unit_scale=True)
+    for epd, puzzle, timed_out, stats, analysis in results:
+        pbar.update(len(epd.encode()))
+        add_stats(total_stats, stats, puzzle, timed_out)
+        with metrics.timed(total_stats, 'output'):
+            writer.write(epd, puzzle, timed_out, analysis)
+        if metrics_writer:
+            metrics_writer.update(total_stats)
+
+    pbar.close()
+    writer.close()
+    report_stats(total_stats)
+    if metrics_writer:
+        metrics.report(metrics_writer.close(total_stats))
+
+
+def analyze_epd(epd, engine, watchdog, retries=1, **kwargs):
+    """
+    Run find_puzzle on an EPD line and return (epd, puzzle, timed_out, stats, analysis).
+    If the engine crashes or has to be killed, it is restarted and the line is analyzed again.
+    """
+    stats = Counter()
+    start_time = time.monotonic()
+    engine.stats = stats if metrics.enabled else None
+    try:
+        for _ in range(retries + 1):
+            analysis = []
+            try:
+                return epd, find_puzzle(epd, engine, watchdog=watchdog, stats=stats, analysis=analysis, **kwargs), False, stats, analysis
+            except TimeoutError:
+                return epd, None, True, stats, None
+            except uci.EngineError as e:
+                sys.stderr.write('Warning: {}, restarting engine\n'.format(e))
+                stats['restarts'] += 1
+                engine.restart()
+        return epd, None, True, stats, None
+    finally:
+        stats['time'] = time.monotonic() - start_time
+
 
-        count_time.clear()
-        if is_timed_out:
-            continue
-
-        if len(pv) > stm_index and (not mate_only or (len(types) > 0 and types[0] == 'mate')):
-            is_tsume_puzzle = types and types[0] == 'mate'
-            if is_tsume_puzzle:
-                for i in range(stm_index, len(pv), 2): 
-                    moves_to_check = pv[:i+1]
-                    is_check = sf.gives_check(current_variant, fen, moves_to_check)
-                    if not is_check:
-                        is_tsume_puzzle = False
-                        break
-
-            std = np.std([value(e, win_threshold) for e in evals])
-            difficulty = 4 * volatilities[0] + 2 * std + accuracies[0]
-            content = len(pv) - stm_index - 40 * volatilities2[0]
-            total_quality = sum(qualities) / len(qualities)
-            # output
-            annotations['variant'] = current_variant
-            if stm_index == 1:
-                annotations['sm'] = pv[0]
-            annotations['bm'] = pv[stm_index]
-            annotations['eval'] = format_eval(evals[0])
-            annotations['difficulty'] = '{:.3f}'.format(difficulty)
-            annotations['content'] = '{:.3f}'.format(content)
-            annotations['quality'] = '{:.3f}'.format(total_quality)
-            annotations['volatility'] = '{:.3f}'.format(volatilities[0])
-            annotations['volatility2'] = '{:.3f}'.format(volatilities2[0])
-            annotations['accuracy'] = '{:.3f}'.format(accuracies[0])
-            annotations['accuracy2'] = '{:.3f}'.format(accuracies2[0])
-            annotations['std'] = '{:.3f}'.format(std)
-            annotations['ambiguity'] = '{:.3f}'.format(max(mate_distance_fractions))
-            if is_tsume_puzzle:
-                annotations['tsume'] = 'true'
-            annotations['type'] = types[0]
-            annotations['pv'] = ','.join(pv)
-            ops = ';'.join('{} {}'.format(k, v) for k, v in annotations.items())
-            outstream.write('{};{}\n'.format(fen, ops))
-        elif failed_file:
-            ff.write_file(epd)
-
-        if i % 100 == 0:
-            outstream.flush()
-
-    if failed_file:
-        ff.close()
+# Engines are kept warm for the lifetime of a (worker) process.
+engine_pool = uci.EnginePool()
+
+
+def checkout_engine(engine_path, ucioptions, multipv):
+    engine = engine_pool.checkout([engine_path], dict(ucioptions, multipv=multipv))
+    sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
+    return engine
+
+
+@contextmanager
+def start_engine(engine_path, ucioptions, multipv):
+    """Check out an engine with the options from the pool, and return it to the pool afterwards."""
+    engine = checkout_engine(engine_path, ucioptions, multipv)
+    try:
+        yield engine
+    finally:
+        engine_pool.checkin(engine)
+
+
+def epd_variant(epd, default_variant):
+    return EpdRecord(epd).get('variant', default_variant) or ''
+
+
+def map_grouped(analyze, lines, default_variant, buffer_size, ordered=True):
+    """
+    Apply analyze, which maps EPD lines to results, to buffers of buffer_size lines sorted by variant,
+    so that the engine rarely needs to switch variants. If ordered, results are returned in input order.
+    """
+    lines = iter(lines)
+    while True:
+        buffer = list(islice(lines, buffer_size))
+        if not buffer:
+            return
+        order = sorted(range(len(buffer)), key=lambda i: epd_variant(buffer[i], default_variant))
+        results = analyze(buffer[i] for i in order)
+        if ordered:
+            restored = [None] * len(buffer)
+            for i, result in zip(order, results):
+                restored[i] = result
+            results = restored
+        yield from results
+
+
+def generate_puzzles(instream, outstream, engine, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, timeout,
+                     keep_hash=False, screen_depths=(), cache=None, checkpoint=None, kill_timeout=10, retries=1, group_variants=0, analysis_file=None, metrics_writer=None):
+    total = input_total(instream)
+    watchdog = uci.Watchdog(engine, timeout, kill_timeout)
+
+    def analyze(epds):
+        for epd in epds:
+            yield analyze_epd(epd, engine, watchdog, retries, variant=variant, depth=depth, win_threshold=win_threshold, unclear_threshold=unclear_threshold,
+                              mate_distance_ratio=mate_distance_ratio, clean_distance=clean_distance, mate_only=mate_only,
+                              keep_hash=keep_hash, screen_depths=screen_depths, cache=cache)
+
+    results = map_grouped(analyze, instream, variant, group_variants) if group_variants else analyze(instream)
+    write_results(results, outstream, failed_file, total, checkpoint, analysis_file, metrics_writer)
+
+
+def rescore(analysis_file, outstream, variant, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, metrics_writer=None):
+    """Write the puzzles recomputed from an analysis file written by generate_puzzles, without running an engine."""
+    results = ((epd, puzzle, False, Counter(), None)
+               for epd, puzzle in rescore_puzzles(read_analyses(analysis_file), variant, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only))
+    write_results(results, outstream, failed_file, None, metrics_writer=metrics_writer)
+
+
+# Engine, watchdog and cache of a worker process, set up by init_worker.
+_worker = {}
+
+
+def init_worker(engine_path, ucioptions, multipv, timeout, kill_timeout, cache_file, cache_size, instrument=False):
+    metrics.enabled = instrument
+    # a worker keeps its engine until the worker exits
+    engine = checkout_engine(engine_path, ucioptions, multipv)
+    _worker['engine'] = engine
+    _worker['watchdog'] = uci.Watchdog(engine, timeout, kill_timeout)
+    _worker['cache'] = AnalysisCache(cache_file, cache_size) if cache_file else None
+
+
+def find_puzzle_worker(epd, retries, **kwargs):
+    return analyze_epd(epd, _worker['engine'], _worker['watchdog'], retries, cache=_worker['cache'], **kwargs)
+
+
+def map_bounded(executor, fn, iterable, max_pending, ordered=True):
+    """Like executor.map, but only keeps max_pending tasks in flight and can yield results as completed."""
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+    if ordered:
+        while pending:
+            yield pending.popleft().result()
+    else:
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def generate_puzzles_parallel(instream, outstream, engine_path, ucioptions, multipv, workers, ordered, variant, depth, win_threshold, unclear_threshold, mate_distance_ratio, clean_distance, mate_only, failed_file, timeout,
+                              keep_hash=False, screen_depths=(), cache_file=None, cache_size=None, checkpoint=None, kill_timeout=10, retries=1, group_variants=0,
+                              analysis_file=None, metrics_writer=None):
+    total = input_total(instream)
+    worker = partial(find_puzzle_worker, retries=retries, variant=variant, depth=depth, win_threshold=win_threshold, unclear_threshold=unclear_threshold,
+                     mate_distance_ratio=mate_distance_ratio, clean_distance=clean_distance, mate_only=mate_only,
+                     keep_hash=keep_hash, screen_depths=screen_depths)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(engine_path, ucioptions, multipv, timeout, kill_timeout, cache_file, cache_size, metrics.enabled)) as executor:
+        def analyze(epds):
+            # keep every worker busy while bounding the number of buffered lines
+            return map_bounded(executor, worker, epds, 4 * workers, ordered)
+
+        results = map_grouped(analyze, instream, variant, group_variants, ordered) if group_variants else analyze(instream)
+        write_results(results, outstream, failed_file, total, checkpoint, analysis_file, metrics_writer)
+
+
+def parse_depths(parser, args):
+    """Set the final search depth from the arguments and return the screening depths."""
+    screen_depths = ()
+    if args.depth_schedule:
+        try:
+            screen_depths, args.depth = depth_schedule(args.depth_schedule, args.depth)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.depth is None:
+        args.depth = 8
+    return screen_depths
+
+
+def check_inputs(parser, args):
+    if args.rescore:
+        if args.epd_files:
+            parser.error('--rescore reads its positions from the analysis file')
+        if args.checkpoint or args.save_analysis or args.range or args.shard:
+            parser.error('--rescore can not be combined with --checkpoint, --save-analysis, --range or --shard')
+    elif not args.engine:
+        parser.error('the following arguments are required: -e/--engine')
+    if (args.range or args.shard) and (not args.epd_files or '-' in args.epd_files):
+        parser.error('--range and --shard require input files')
+
+
+def open_checkpoint(parser, args, reader):
+    """Return the checkpoint of the arguments, if any, after resuming from it if requested."""
+    if not args.checkpoint:
+        if args.resume:
+            parser.error('--resume requires --checkpoint')
+        return None
+    if not args.output:
+        parser.error('--checkpoint requires --output')
+    if not args.epd_files or '-' in args.epd_files:
+        parser.error('--checkpoint requires input files')
+    if args.unordered:
+        parser.error('--checkpoint requires ordered output')
+    checkpoint = Checkpoint(args.checkpoint, reader, args.checkpoint_interval)
+    if args.resume:
+        checkpoint.resume(args.output, args.failed_file, args.save_analysis)
+    return checkpoint
+
+
+def run(args, instream, outstream, screen_depths, checkpoint, metrics_writer):
+    """Rescore the analysis file or analyze the input with one or more engines, as given by the arguments."""
+    if args.rescore:
+        # there is no engine to load the custom variants of the analyses into pyffish
+        sf.set_option("VariantPath", dict(args.ucioptions).get("VariantPath", ""))
+        rescore(args.rescore, outstream, args.variant, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file,
+                metrics_writer)
+    elif args.workers > 1:
+        generate_puzzles_parallel(instream, outstream, args.engine, dict(args.ucioptions), args.multipv, args.workers, not args.unordered,
+                                  args.variant, args.depth, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file, args.timeout,
+                                  args.keep_hash, screen_depths, args.cache, args.cache_size, checkpoint, args.kill_timeout, args.retries, args.group_variants,
+                                  args.save_analysis, metrics_writer)
+    else:
+        cache = AnalysisCache(args.cache, args.cache_size) if args.cache else None
+        with start_engine(args.engine, dict(args.ucioptions), args.multipv) as engine:
+            generate_puzzles(instream, outstream, engine, args.variant, args.depth, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file, args.timeout,
+                             args.keep_hash, screen_depths, cache, checkpoint, args.kill_timeout, args.retries, args.group_variants, args.save_analysis,
+                             metrics_writer)
+        engine_pool.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('epd_files', nargs='*')
-    parser.add_argument('-e', '--engine', required=True)
+    parser.add_argument('-e', '--engine', help='required unless rescoring')
     parser.add_argument('-o', '--ucioptions', type=lambda kv: kv.split("="), action='append', default=[],
                         help='UCI option as key=value pair. Repeat to add more options.')
     parser.add_argument('-v', '--variant', help='only required if not annotated in input FEN/EPD')
     parser.add_argument('-m', '--multipv', type=int, default=2)
-    parser.add_argument('-d', '--depth', type=int, default=8, help='Engine search depth. Important for puzzle accuracy.')
+    parser.add_argument('-d', '--depth', type=int, help='Engine search depth. Important for puzzle accuracy. (default: 8)')
+    parser.add_argument('--depth-schedule', type=lambda s: [int(d) for d in s.split(',')],
+                        help='comma separated increasing depths, e.g. 4,8,14. Positions are only searched deeper while they are still puzzle candidates. '
+                             'The last depth replaces --depth, unless --depth is deeper.')
     parser.add_argument('-w', '--win-threshold', type=int, default=400, help='centipawn threshold for winning positions')
     parser.add_argument('-u', '--unclear-threshold', type=int, default=100, help='centipawn threshold for unclear positions')
     parser.add_argument('-r', '--mate-distance-ratio', type=float, default=1.5, help='minimum ratio of second best to best mate distance')
@@ -275,10 +787,37 @@ if __name__ == '__main__':
     parser.add_argument('--mate-only', action='store_true', help='do not generate puzzles other than mates (small speedup)')
     parser.add_argument('-f', '--failed-file', help='output file name for epd lines producing no puzzle')
     parser.add_argument('-t', '--timeout', type=int, default=600, help='maximum time to analysis a single fen in seconds')
+    parser.add_argument('--kill-timeout', type=float, default=10, help='seconds to wait for the engine to stop after a timeout before restarting it')
+    parser.add_argument('--retries', type=int, default=1, help='number of times a position is analyzed again after an engine crash')
+    parser.add_argument('--keep-hash', action='store_true', help='keep the engine hash while extending the line of a puzzle')
+    parser.add_argument('--cache', help='SQLite file to store and reuse engine analyses across runs')
+    parser.add_argument('--cache-size', type=int, default=1000000, help='maximum number of cached analyses')
+    parser.add_argument('--group-variants', type=int, default=0, metavar='N',
+                        help='analyze buffers of N lines grouped by variant to avoid switching variants, output order is preserved')
+    parser.add_argument('--workers', type=int, default=1, help='number of parallel engine processes')
+    parser.add_argument('--unordered', action='store_true', help='with multiple workers, write puzzles as completed instead of in input order')
+    parser.add_argument('--output', help='output file name (default: stdout)')
+    parser.add_argument('--checkpoint', help='file to periodically save the progress to, requires --output')
+    parser.add_argument('--checkpoint-interval', type=float, default=60, help='seconds between checkpoints')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint if it exists')
+    parser.add_argument('--range', type=parse_range, help='only analyze the lines start:end of the input, counting from 0')
+    parser.add_argument('--shard', type=parse_shard, help='only analyze the i-th of N equally sized parts of the input, counting from 0, written as i/N')
+    parser.add_argument('--save-analysis', help='binary file to store the engine analyses to, for later use with --rescore')
+    parser.add_argument('--rescore', help='recompute puzzles from an analysis file written by --save-analysis instead of running an engine, '
+                                          'e.g., to tune thresholds. Lines can not be extended beyond the stored analysis.')
+    parser.add_argument('--timings', action='store_true', help='measure the time spent per stage, e.g., engine search, info parsing and rating, and print a summary')
+    parser.add_argument('--metrics', help='file to periodically append the metrics of the run to as JSON lines, implies --timings')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='seconds between metrics dumps')
     args = parser.parse_args()
-
-    engine = uci.Engine([args.engine], dict(args.ucioptions))
-    engine.setoption('multipv', args.multipv)
-    sf.set_option("VariantPath", engine.options.get("VariantPath", ""))
-    with fileinput.input(args.epd_files) as instream:
-        generate_puzzles(instream, sys.stdout, engine, args.variant, args.depth, args.win_threshold, args.unclear_threshold, args.mate_distance_ratio, args.clean_distance, args.mate_only, args.failed_file, args.timeout)
+    screen_depths = parse_depths(parser, args)
+    check_inputs(parser, args)
+    reader = EpdReader(args.epd_files, args.range, args.shard)
+    checkpoint = open_checkpoint(parser, args, reader)
+
+    metrics.enabled = args.timings or bool(args.metrics)
+    metrics_writer = metrics.MetricsWriter(args.metrics, args.metrics_interval) if metrics.enabled else None
+
+    # stdout stays open for the reports after the run
+    output = open(args.output, 'a' if checkpoint and checkpoint.resumed else 'w') if args.output else nullcontext(sys.stdout)
+    with output as outstream:
+        run(args, checkpoint.lines() if checkpoint else reader, outstream, screen_depths, checkpoint, metrics_writer)
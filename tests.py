@@ -1,9 +1,30 @@
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
 import unittest
+from unittest.mock import patch
 import sys
 
+import numpy as np
+import pyffish as sf
+
+import analysis
+import cache
+import deduplicate
+import epdfile
+import filter
+import metrics
 import pgn
 import kif
+import positions
+import puzzler
+import uci
 
 
 class TestPgn(unittest.TestCase):
@@ -27,6 +48,15 @@ class TestPgn(unittest.TestCase):
         pgn.epd_to_pgn(instream, outstream)
         self.assertIn('31... Nef2+ 32. Qxf2 Nxf2+', outstream.getvalue())
 
+    def test_move_numbers(self):
+        instream = [self.TEST_PUZZLE + '\n', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -;variant chess;pv e2e4,e7e5,g1f3,b8c6\n']
+        outstream = StringIO()
+        pgn.epd_to_pgn(instream, outstream, chunk_size=1)
+        self.assertIn('1. e4 e5 2. Nf3 Nc6 *', outstream.getvalue())
+        bulk = StringIO()
+        pgn.epd_to_pgn(instream, bulk)
+        self.assertEqual(bulk.getvalue(), outstream.getvalue())
+
 
 class TestKif(unittest.TestCase):
     # Shogi puzzle in EPD format - using default start position with some moves
@@ -107,6 +137,16 @@ class TestKif(unittest.TestCase):
         finally:
             sys.stderr = original_stderr
 
+    def test_kif_export_whitespace(self):
+        """Whitespace around the separators of annotations is tolerated"""
+        fen, annotations = self.TEST_SHOGI_PUZZLE.strip().split(';', 1)
+        expected = StringIO()
+        kif.epd_to_kif(StringIO(self.TEST_SHOGI_PUZZLE), expected)
+        outstream = StringIO()
+        kif.epd_to_kif(StringIO(fen + ' ; ' + ' ; '.join(annotations.split(';')) + ' \n'), outstream)
+        self.assertEqual(outstream.getvalue(), expected.getvalue())
+        self.assertIn('手数----指手---------消費時間--', outstream.getvalue())
+
     def test_kif_export_non_shogi(self):
         """Test KIF export skips non-shogi variants"""
         non_shogi_puzzle = '3r4/2Rpk1pp/p2pp1b1/3p2N1/1Q1PnBPn/3bPP1n/P2Q3P/R6K[RBPPP] b - - 4 31;variant crazyhouse;pv e4f2,d2f2,h3f2'
@@ -156,5 +196,592 @@ class TestKif(unittest.TestCase):
             sys.stderr = original_stderr
 
 
+class TestDeduplicate(unittest.TestCase):
+    def test_similarity_index(self):
+        rng = random.Random(0)
+        items = [(square, piece) for square in ('a1', 'b2', 'c3', 'd4', 'e5', 'f6') for piece in 'KQRkqr']
+        puzzles = [(frozenset(rng.sample(items, rng.randint(2, 8))), tuple(rng.choice('ABC') for _ in range(rng.randint(1, 4))), str(i))
+                   for i in range(300)]
+        for thresholds in ((0.8, 0.8, 0.5), (0.5, 0.9, 0.3), (0, 0.5, 0.9), (-1, 1, 1)):
+            index = deduplicate.SimilarityIndex(*thresholds)
+            retained = []
+            for board, sans, epd in puzzles:
+                similarities = ((i, deduplicate.board_similarity(board, board2), deduplicate.move_similarity(sans, sans2)) for i, (board2, sans2) in enumerate(retained))
+                expected = next(((i, board_sim, move_sim, board_sim * move_sim) for i, board_sim, move_sim in similarities
+                                 if board_sim > thresholds[0] or move_sim > thresholds[1] or board_sim * move_sim > thresholds[2]), None)
+                self.assertEqual(index.find(board, sans), expected)
+                if expected is None:
+                    index.add(board, sans, epd)
+                    retained.append((board, sans))
+
+    def test_pieces_in_hand(self):
+        # pieces in hand are mapped to pseudo-squares beyond the board, which must not collide with board squares
+        board = frozenset(deduplicate.fen_to_square_map('k7/8/8/8/8/8/8/K7[PPPPP] w - - 0 1').items())
+        board2 = frozenset(deduplicate.fen_to_square_map('k7/8/8/8/8/8/P7/K7 w - - 0 1').items())
+        self.assertIn(('m1', 'P'), board)
+        self.assertAlmostEqual(deduplicate.board_similarity(board, board2), 0.4)
+        index = deduplicate.SimilarityIndex(0.5, 2, 2)
+        index.add(board, ('Pa2',))
+        self.assertIsNone(index.find(board2, ('Ka2',)))
+        index = deduplicate.SimilarityIndex(0.3, 2, 2)
+        index.add(board, ('Pa2',))
+        self.assertAlmostEqual(index.find(board2, ('Ka2',))[1], 0.4)
+
+    def test_feature_cache(self):
+        epds = ['4k3/8/4K3/8/8/8/8/R7 w - -;variant chess;pv a1a8\n',
+                'r5k1/5ppp/8/8/8/8/8/4R1K1 w - -;variant chess;pv e1e8,a8e8\n']
+        expected = [(frozenset({('e8', 'k'), ('e6', 'K'), ('a8', 'R')}), ('Ra8#',), 'R-a8-k-e8'),
+                    (frozenset({('e8', 'r'), ('f7', 'p'), ('g7', 'p'), ('h7', 'p'), ('g8', 'k'), ('g1', 'K')}), ('Re8+', 'Rxe8'), 'R-e8-K-g1')]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            feature_cache = deduplicate.FeatureCache(os.path.join(tmpdir, 'features.db'))
+            self.assertEqual(deduplicate.extract_features(epds, 'k', workers=2, cache=feature_cache), expected)
+            self.assertEqual(feature_cache.get('chess', '4k3/8/4K3/8/8/8/8/R7 w - -', ['a1a8']), ('R3k3/8/4K3/8/8/8/8/8 b - - 1 1', 'Ra1-a8#', ('Ra8#',)))
+            feature_cache.put_many([(('chess', '4k3/8/4K3/8/8/8/8/R7 w - -', ('a1a8',)), ('4k3/8/4K3/8/8/8/8/R7 b - - 1 1', 'Ra1-a2', ('Ra2',)))])
+            self.assertEqual(deduplicate.extract_features(epds[:1], 'k', cache=feature_cache)[0][1:], (('Ra2',), 'R-a2-k-e8'))
+            feature_cache.close()
+
+    def test_external_sort(self):
+        rng = random.Random(0)
+        lines = ['fen;rank {};id {}\n'.format(rng.randint(0, 20), i) for i in range(1000)]
+        key = lambda line: deduplicate.get_sort_key([('rank', 'd')], line)
+        self.assertEqual(list(deduplicate.external_sort(lines, key, 1000)), sorted(lines, key=key))
+        self.assertEqual(list(deduplicate.external_sort(lines, key, 10 ** 6)), sorted(lines, key=key))
+
+    def test_streaming(self):
+        epds = ['4k3/8/4K3/8/8/8/8/R7 w - -;variant chess;rank 1;pv a1a8\n',
+                'r5k1/5ppp/8/8/8/8/8/4R1K1 w - -;variant chess;rank 3;pv e1e8,a8e8\n',
+                '4k3/8/3K4/8/8/8/8/R7 w - -;variant chess;rank 2;pv a1a8\n',
+                '6k1/5ppp/8/8/8/8/8/R5K1 w - -;variant chess;rank 2;pv a1a8\n'] * 20
+        expected = StringIO()
+        deduplicate.deduplicate(epds, expected, 'k', [('rank', 'd')], 0.8, 0.8, 0.5)
+        self.assertEqual(expected.getvalue(), epds[1] + epds[2])
+        output = StringIO()
+        deduplicate.deduplicate(epds, output, 'k', [('rank', 'd')], 0.8, 0.8, 0.5, max_memory=2000)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_index(self):
+        epds = ['4k3/8/4K3/8/8/8/8/R7 w - -;variant chess;pv a1a8\n',
+                'r5k1/5ppp/8/8/8/8/8/4R1K1 w - -;variant chess;pv e1e8,a8e8\n',
+                '4k3/8/3K4/8/8/8/8/R7 w - -;variant chess;pv a1a8\n',
+                '6k1/5ppp/8/8/8/8/8/1R4K1 w - -;variant chess;pv b1b8\n']
+        expected = StringIO()
+        deduplicate.deduplicate(epds, expected, 'k')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'puzzles.idx')
+            outputs = []
+            for batch in (epds[:1], epds[1:3], epds):
+                index = deduplicate.PuzzleIndex(path)
+                outputs.append(StringIO())
+                deduplicate.deduplicate(batch, outputs[-1], 'k', index=index)
+            self.assertEqual(outputs[0].getvalue() + outputs[1].getvalue(), expected.getvalue())
+            self.assertEqual(outputs[2].getvalue(), '')
+            index = deduplicate.PuzzleIndex(path)
+            self.assertEqual(len(index), 2)
+            # each run that writes puzzles only adds a segment
+            self.assertEqual([segment.start for segment in index.segments], [0, 1])
+            self.assertIsInstance(index.segments[0].boards.base, np.memmap)
+            self.assertEqual([list(segment.arrays['patterns']) for segment in index.segments], [['R-a8-k-e8'], ['R-e8-K-g1']])
+            self.assertTrue(index.has_pattern('R-e8-K-g1'))
+            self.assertFalse(index.has_pattern('R-b8-k-g8'))
+            # continuing from the stored segments finds the same puzzles as the index they were stored from
+            similarity_index = deduplicate.SimilarityIndex(0.8, 0.8, 0.5)
+            for board, sans, _ in deduplicate.extract_features(epds[:2], 'k'):
+                similarity_index.add(board, sans)
+            stored = index.similarity_index(0.8, 0.8, 0.5)
+            for board, sans, _ in deduplicate.extract_features(epds, 'k'):
+                self.assertEqual(stored.find(board, sans), similarity_index.find(board, sans))
+
+
+    def test_index_thresholds(self):
+        epds = ['6k1/5ppp/8/8/8/8/5PPP/R5K1 w - -;variant chess;pv a1a8\n',
+                '6k1/5ppp/8/8/8/8/5PP1/1R4K1 w - -;variant chess;pv b1b8\n',
+                '6k1/5ppp/8/8/8/7P/5PP1/2R3K1 w - -;variant chess;pv c1c8\n']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # board prefixes selected for a high threshold miss boards that are similar for a lower one
+            path = os.path.join(tmpdir, 'strict.idx')
+            deduplicate.deduplicate(epds[:1], StringIO(), 'k', board_similarity_threshold=0.95, index=deduplicate.PuzzleIndex(path))
+            with self.assertRaises(ValueError):
+                deduplicate.deduplicate(epds[1:], StringIO(), 'k', board_similarity_threshold=0.5, index=deduplicate.PuzzleIndex(path))
+            # longer prefixes of a lower threshold still find all similar boards for a higher one
+            for board_threshold in (0.5, 0.8, 0.95):
+                expected = StringIO()
+                deduplicate.deduplicate(epds, expected, 'k', board_similarity_threshold=board_threshold)
+                path = os.path.join(tmpdir, 'loose{}.idx'.format(board_threshold))
+                outputs = [StringIO(), StringIO()]
+                deduplicate.deduplicate(epds[:1], outputs[0], 'k', board_similarity_threshold=0.5, index=deduplicate.PuzzleIndex(path))
+                deduplicate.deduplicate(epds[1:], outputs[1], 'k', board_similarity_threshold=board_threshold, index=deduplicate.PuzzleIndex(path))
+                self.assertEqual(outputs[0].getvalue() + outputs[1].getvalue(), expected.getvalue())
+
+
+class TestPuzzler(unittest.TestCase):
+    MOCK_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_engine.py')
+    START = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1;variant chess\n'
+
+    def find_puzzle(self, seed, **kwargs):
+        """Run find_puzzle with the mock engine and return the puzzle, the stats and the commands sent to the engine."""
+        engine = uci.Engine([sys.executable, self.MOCK_ENGINE], {'MultiPV': 2, 'WinRate': 70, 'MateRate': 0, 'Seed': seed})
+        commands = []
+        write = engine.write
+
+        def record(message):
+            commands.append(message.strip())
+            write(message)
+        engine.write = record
+        stats = Counter()
+        try:
+            puzzle = puzzler.find_puzzle(self.START, engine, None, 3, 400, 100, 1.5, 0, False, uci.Watchdog(engine, 60), stats=stats, **kwargs)
+        finally:
+            engine.close()
+        return puzzle, stats, commands
+
+    def test_keep_hash(self):
+        puzzle, stats, commands = self.find_puzzle(2, keep_hash=True)
+        self.assertIn(';pv d2d4,b7b5,e2e3,a7a6,c2c4', puzzle)
+        searches = [i for i, command in enumerate(commands) if command.startswith('go')]
+        newgames = [i for i, command in enumerate(commands) if command == 'ucinewgame']
+        self.assertEqual(len(newgames), 1)
+        self.assertLess(newgames[0], searches[0])
+        self.assertEqual((stats['searches'], stats['continuation_searches']), (4, 3))
+        self.assertEqual(stats['continuation_nodes'], 3 * 3000)
+
+        _, stats, commands = self.find_puzzle(2)
+        self.assertEqual(commands.count('ucinewgame'), 4)
+        self.assertEqual(stats['continuation_searches'], 0)
+
+    def test_depth_schedule(self):
+        puzzle, stats, commands = self.find_puzzle(0, screen_depths=(1,))
+        self.assertIsNone(puzzle)
+        self.assertEqual([command for command in commands if command.startswith('go')], ['go depth 1'])
+        self.assertEqual((stats['screened_out'], stats['searches']), (1, 0))
+        puzzle, stats, commands = self.find_puzzle(2, screen_depths=(1,))
+        self.assertIn(';pv d2d4,b7b5,e2e3,a7a6,c2c4', puzzle)
+        # the ply ending the line is screened out before its full depth search
+        self.assertEqual((stats['screened_out'], stats['searches']), (1, 3))
+
+        self.assertEqual(puzzler.depth_schedule([4, 8, 14]), ((4, 8), 14))
+        self.assertEqual(puzzler.depth_schedule([4, 8], 14), ((4, 8), 14))
+        self.assertEqual(puzzler.depth_schedule([4, 8, 14], 14), ((4, 8), 14))
+        for schedule, depth in (([8, 4, 14], None), ([4, 4, 14], None), ([0, 8], None), ([4, 8, 14], 10)):
+            with self.assertRaises(ValueError):
+                puzzler.depth_schedule(schedule, depth)
+
+    def test_report_stats(self):
+        stats = Counter(searches=4, nodes=1000, continuation_searches=3, continuation_nodes=300)
+        with patch('sys.stderr', new_callable=StringIO) as stderr:
+            puzzler.report_stats(stats)
+        self.assertIn('Continuation searches: 3, nodes: 300\n', stderr.getvalue())
+        with patch('sys.stderr', new_callable=StringIO) as stderr:
+            puzzler.report_stats(Counter(searches=2, nodes=600))
+        self.assertNotIn('Continuation', stderr.getvalue())
+
+    def test_map_bounded_order(self):
+        def slow_square(x):
+            time.sleep(0.01 * (5 - x))
+            return x * x
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            self.assertEqual(list(puzzler.map_bounded(executor, slow_square, range(5), 2)), [0, 1, 4, 9, 16])
+            self.assertEqual(sorted(puzzler.map_bounded(executor, slow_square, range(5), 2, ordered=False)), [0, 1, 4, 9, 16])
+
+    def test_map_grouped(self):
+        epds = ['fen{};variant {}\n'.format(i, variant) for i, variant in enumerate(['chess', 'shogi', 'chess', 'shogi', 'chess'])]
+        analyzed = []
+
+        def analyze(lines):
+            for line in lines:
+                analyzed.append(line)
+                yield line.upper()
+        results = list(puzzler.map_grouped(analyze, epds, None, 4))
+        self.assertEqual(results, [epd.upper() for epd in epds])
+        self.assertEqual(analyzed, [epds[0], epds[2], epds[1], epds[3], epds[4]])
+
+    def test_rate_puzzles(self):
+        def info(*scores):
+            return [[{'score': score.split(), 'pv': [move]} for score, move in zip(multiinf, ('e2e4', 'd2d4'))] for multiinf in scores]
+        infos = [info(('cp 300', 'cp 0'), ('cp 500', 'cp -100')), info(('mate 2', 'mate 4'))]
+        ratings = puzzler.rate_puzzles(infos, 400)
+        self.assertEqual(len(ratings), 2)
+        for search, rating in zip(infos, ratings):
+            self.assertEqual(len(rating), 6)
+            self.assertEqual(puzzler.rate_puzzle(search, 400), rating)
+        v = [puzzler.value({'score': ['cp', str(cp)]}, 400) for cp in (300, 0, 500, -100)]
+        for actual, expected in zip(ratings[0], ((v[2] - v[0]) / 2, (v[1] - v[3]) / 2, (v[2] - v[0]) / 2, (v[1] - v[3]) / 2,
+                                                 (v[0] - v[1] + v[2] - v[3]) / 2, 0)):
+            self.assertAlmostEqual(actual, expected)
+        self.assertEqual(ratings[1], (0, 0, 0, 0, 0, 0.5))
+        self.assertEqual(puzzler.get_puzzle_themes([search[-1] for search in infos], 400, 100, 0), ['winning', None])
+        self.assertEqual(puzzler.get_puzzle_themes([search[-1] for search in infos], 400, 100, 1.5), ['winning', 'mate'])
+
+    def test_checkpoint_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epd_file = os.path.join(tmpdir, 'in.epd')
+            output_file = os.path.join(tmpdir, 'out.epd')
+            checkpoint_file = os.path.join(tmpdir, 'checkpoint')
+            with open(epd_file, 'w') as f:
+                f.writelines('line{}\n'.format(i) for i in range(5))
+
+            checkpoint = puzzler.Checkpoint(checkpoint_file, epdfile.EpdReader([epd_file]))
+            with open(output_file, 'w') as outstream:
+                lines = checkpoint.lines()
+                for line in lines:
+                    outstream.write(line)
+                    checkpoint.done(outstream, None)
+                    if line == 'line1\n':
+                        checkpoint.save(outstream, None)
+                    if line == 'line2\n':
+                        break
+            # line2 was written after the last checkpoint and needs to be discarded
+
+            checkpoint = puzzler.Checkpoint(checkpoint_file, epdfile.EpdReader([epd_file]))
+            checkpoint.resume(output_file, None)
+            self.assertTrue(checkpoint.resumed)
+            with open(output_file, 'a') as outstream:
+                for line in checkpoint.lines():
+                    outstream.write(line)
+                    checkpoint.done(outstream, None)
+            with open(output_file) as f:
+                self.assertEqual(f.read(), ''.join('line{}\n'.format(i) for i in range(5)))
+
+
+class TestUci(unittest.TestCase):
+    INFO_LINE = 'info depth 12 seldepth 18 multipv 2 score cp -34 upperbound nodes 123456 nps 1234567 hashfull 12 tbhits 0 time 100 pv e2e4 e7e5 g1f3\n'
+
+    def test_parse_info(self):
+        self.assertTrue(uci.is_score_info(self.INFO_LINE))
+        self.assertFalse(uci.is_score_info('info string score cp 10\n'))
+        self.assertEqual(uci.parse_info(self.INFO_LINE), {'depth': 12, 'seldepth': 18, 'multipv': 2, 'nodes': 123456, 'nps': 1234567, 'time': 100,
+                                                         'score': ['cp', '-34', 'upperbound'], 'pv': ['e2e4', 'e7e5', 'g1f3']})
+
+    def test_parse_info_fields(self):
+        self.assertEqual(uci.parse_info(self.INFO_LINE, ('score', 'pv')), {'score': ['cp', '-34', 'upperbound'], 'pv': ['e2e4', 'e7e5', 'g1f3']})
+        self.assertEqual(uci.parse_info('info depth 3 score mate -2 pv a1a2\n', ('depth', 'multipv', 'score')), {'depth': 3, 'score': ['mate', '-2']})
+
+
+# Minimal UCI engine, replies to go after a stop for infinite searches
+STUB_ENGINE = """
+import sys
+for line in sys.stdin:
+    command = line.split()[0] if line.split() else ''
+    if command == 'uci':
+        print('id name Stub\\nuciok', flush=True)
+    elif command == 'isready':
+        print('readyok', flush=True)
+    elif command in ('go', 'stop') and (command == 'stop' or 'infinite' not in line):
+        print('info depth 1 multipv 1 score cp 10 nodes 5 pv e2e4', flush=True)
+        print('info depth 2 multipv 1 score cp 20 nodes 9 pv d2d4 d7d5', flush=True)
+        print('bestmove d2d4', flush=True)
+    elif command == 'quit':
+        break
+"""
+
+
+class TestMockEngine(unittest.TestCase):
+    MOCK_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_engine.py')
+
+    def test_synthetic(self):
+        engine = uci.Engine([sys.executable, self.MOCK_ENGINE], {'MultiPV': 2})
+        self.assertEqual(engine.id, 'MockEngine')
+        engine.newgame()
+        engine.position(None, ['e2e4'])
+        bestmove, infos = engine.go(depth=3)
+        self.assertEqual([len(info) for info in infos], [2, 2, 2])
+        self.assertIn(bestmove, sf.legal_moves('chess', sf.start_fen('chess'), ['e2e4']))
+        self.assertEqual(infos[-1][0]['pv'][0], bestmove)
+        self.assertEqual(engine.go(depth=3), (bestmove, infos))
+        engine.close()
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as tmpd:
+            log = os.path.join(tmpd, 'engine.log')
+            with open(log, 'w') as f:
+                f.write('info depth 1 multipv 1 score cp 10 pv e2e4\ninfo depth 2 multipv 1 score cp 20 pv d2d4 d7d5\nbestmove d2d4\n'
+                        'info depth 1 multipv 1 score mate 1 pv f7f8q\nbestmove f7f8q\n')
+            engine = uci.Engine([sys.executable, self.MOCK_ENGINE], {'Replay': log})
+            engine.position()
+            self.assertEqual([engine.go(depth=2)[0] for _ in range(3)], ['d2d4', 'f7f8q', 'd2d4'])
+            engine.close()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_timings(self):
+        stats = Counter()
+        with metrics.timed(stats, 'rating'):
+            pass
+        self.assertNotIn('rating_time', stats)
+
+        engine = uci.Engine([sys.executable, '-c', STUB_ENGINE])
+        engine.stats = stats
+        engine.go(depth=2)
+        self.assertEqual(stats['info_lines'], 3)
+        self.assertGreater(stats['engine_time'], 0)
+        engine.close()
+
+        metrics.enabled = True
+        try:
+            with metrics.timed(stats, 'rating'):
+                pass
+        finally:
+            metrics.enabled = False
+        stats.update({'positions': 4, 'puzzles': 1, 'nodes': 9})
+        snapshot = metrics.snapshot(stats, 2)
+        self.assertEqual((snapshot['positions_per_second'], snapshot['yield']), (2, 0.25))
+        self.assertEqual(set(snapshot['stages']), {'engine', 'parse', 'rating'})
+
+
+class TestAsyncEngine(unittest.TestCase):
+    def test_go(self):
+        async def run():
+            engine = await uci.AsyncEngine.create([sys.executable, '-c', STUB_ENGINE])
+            self.assertEqual(engine.id, 'Stub')
+            await engine.newgame()
+            await engine.position()
+            bestmove, infos = await engine.go(depth=2)
+            self.assertEqual(bestmove, 'd2d4')
+            self.assertEqual([info[0]['score'] for info in infos], [['cp', '10'], ['cp', '20']])
+            _, infos = await engine.go(fields=('pv',), history=False, depth=2)
+            self.assertEqual(infos, [[{'depth': 2, 'multipv': 1, 'pv': ['d2d4', 'd7d5']}]])
+            await engine.quit()
+        asyncio.run(run())
+
+    def test_cancel(self):
+        async def run():
+            engine = await uci.AsyncEngine.create([sys.executable, '-c', STUB_ENGINE])
+            search = asyncio.ensure_future(engine.go(infinite=''))
+            await asyncio.sleep(0.1)
+            search.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await search
+            bestmove, _ = await engine.go(depth=2)
+            self.assertEqual(bestmove, 'd2d4')
+            await engine.quit()
+        asyncio.run(run())
+
+
+class TestEnginePool(unittest.TestCase):
+    def test_reuse_and_replace(self):
+        pool = uci.EnginePool()
+        # quits the returned engines and closes their pipes
+        self.addCleanup(pool.close)
+        with pool.engine([sys.executable, '-c', STUB_ENGINE], {'Hash': 16}) as engine:
+            pid = engine.process.pid
+        with pool.engine([sys.executable, '-c', STUB_ENGINE], {'Hash': 16}) as engine:
+            self.assertEqual(engine.process.pid, pid)
+            engine.kill()
+        with pool.engine([sys.executable, '-c', STUB_ENGINE], {'Hash': 16}) as engine:
+            self.assertNotEqual(engine.process.pid, pid)
+            self.assertIsNone(engine.process.poll())
+        with pool.engine([sys.executable, '-c', STUB_ENGINE], {'Hash': 32}) as other_engine:
+            self.assertIsNot(other_engine, engine)
+
+    def test_changed_options(self):
+        pool = uci.EnginePool()
+        # quits the returned engines and closes their pipes
+        self.addCleanup(pool.close)
+        args = [sys.executable, '-c', STUB_ENGINE]
+        with pool.engine(args, {'Hash': 16}, 'chess') as engine:
+            engine.setoption('UCI_Variant', 'crazyhouse')
+        # the engine is only reused for the options it has now
+        with pool.engine(args, {'Hash': 16}, 'chess') as other_engine:
+            self.assertIsNot(other_engine, engine)
+        with pool.engine(args, {'Hash': 16}, 'crazyhouse') as same_engine:
+            self.assertIs(same_engine, engine)
+
+
+class TestWatchdog(unittest.TestCase):
+    class StubEngine():
+        def __init__(self):
+            self.stopped = False
+            self.process = SimpleNamespace(kill=self.kill, killed=False)
+
+        def stop(self):
+            self.stopped = True
+
+        def kill(self):
+            self.process.killed = True
+
+    def test_cancel(self):
+        engine = self.StubEngine()
+        watchdog = uci.Watchdog(engine, 0.1, 0.1)
+        watchdog.start()
+        watchdog.cancel()
+        time.sleep(0.3)
+        self.assertFalse(watchdog.timed_out)
+        self.assertFalse(engine.stopped)
+
+    def test_stop_and_kill(self):
+        engine = self.StubEngine()
+        watchdog = uci.Watchdog(engine, 0.05, 10)
+        watchdog.start()
+        time.sleep(0.3)
+        self.assertTrue(watchdog.timed_out)
+        self.assertTrue(engine.stopped)
+        self.assertFalse(engine.process.killed)
+
+        watchdog = uci.Watchdog(engine, 0.05, 0.05)
+        watchdog.start()
+        time.sleep(0.3)
+        self.assertTrue(watchdog.killed)
+        self.assertTrue(engine.process.killed)
+
+
+class TestAnalysisCache(unittest.TestCase):
+    INFOS = [[{'depth': d, 'multipv': m, 'score': ['cp', str(10 * d - m)], 'pv': ['e2e4']} for m in (1, 2)] for d in (1, 2, 3)]
+
+    def test_depth(self):
+        analysis_cache = cache.AnalysisCache(':memory:')
+        analysis_cache.put('engine', 'chess', 'fen', ['e2e4'], 2, 3, self.INFOS)
+        self.assertEqual(analysis_cache.get('engine', 'chess', 'fen', ['e2e4'], 2, 3), self.INFOS)
+        self.assertEqual(analysis_cache.get('engine', 'chess', 'fen', ['e2e4'], 2, 2), self.INFOS[:2])
+        self.assertIsNone(analysis_cache.get('engine', 'chess', 'fen', ['e2e4'], 2, 4))
+        self.assertIsNone(analysis_cache.get('engine', 'chess', 'fen', [], 2, 1))
+
+    def test_engine_key(self):
+        key = cache.engine_key('Fairy-Stockfish', {'EvalFile': 'a.nnue', 'Hash': 64, 'multipv': 2, 'VariantPath': 'variants.ini'})
+        self.assertEqual(key, 'Fairy-Stockfish evalfile=a.nnue variantpath=variants.ini')
+        self.assertEqual(cache.engine_key('Fairy-Stockfish', {'variantpath': 'variants.ini', 'Threads': 4, 'UCI_Variant': 'shogi', 'EvalFile': 'a.nnue'}), key)
+        self.assertNotEqual(cache.engine_key('Fairy-Stockfish', {'EvalFile': 'b.nnue', 'VariantPath': 'variants.ini'}), key)
+
+    def test_eviction(self):
+        analysis_cache = cache.AnalysisCache(':memory:', max_entries=2)
+        for fen in ('fen1', 'fen2', 'fen3'):
+            analysis_cache.put('engine', 'chess', fen, [], 2, 3, self.INFOS)
+        analysis_cache.get('engine', 'chess', 'fen1', [], 2, 3)
+        analysis_cache.evict()
+        self.assertIsNotNone(analysis_cache.get('engine', 'chess', 'fen1', [], 2, 3))
+        self.assertIsNone(analysis_cache.get('engine', 'chess', 'fen2', [], 2, 3))
+        self.assertIsNotNone(analysis_cache.get('engine', 'chess', 'fen3', [], 2, 3))
+
+
+class TestPositions(unittest.TestCase):
+    def test_positions(self):
+        position_cache = positions.PositionCache(max_entries=4)
+        variant = 'crazyhouse'
+        fen = sf.start_fen(variant)
+        moves = ['e2e4', 'd7d5', 'e4d5', 'g8f6', 'd5d6', 'f6e4', 'd6c7', 'e4d2', 'c7d8q', 'e8d8']
+        for i in range(len(moves) + 1):
+            self.assertEqual(position_cache.get_fen(variant, fen, moves[:i]), sf.get_fen(variant, fen, moves[:i]))
+            self.assertEqual(position_cache.get_fen(variant, fen, moves[:i], False, True, True), sf.get_fen(variant, fen, moves[:i], False, True, True))
+            self.assertEqual(position_cache.legal_moves(variant, fen, moves[:i]), sf.legal_moves(variant, fen, moves[:i]))
+            self.assertEqual(position_cache.gives_check(variant, fen, moves[:i]), sf.gives_check(variant, fen, moves[:i]))
+        self.assertEqual(position_cache.misses, len(moves) + 1)
+        self.assertEqual(len(position_cache.entries), 4)
+
+
+class TestAnalysisFile(unittest.TestCase):
+    def test_rescore(self):
+        def info(*scores):
+            return [[{'depth': depth, 'score': score.split(), 'pv': pv.split()} for score, pv in zip(multiinf, ('e2e4 e7e5', 'd2d4'))]
+                    for depth, multiinf in enumerate(scores, 1)]
+        epd = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1;variant chess\n'
+        plies = [puzzler.ply_analysis(info(('cp 300', 'cp 0'), ('cp 500', 'cp -100'))), puzzler.ply_analysis(info(('cp 100', 'cp 0')))]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            analysis_file = os.path.join(tmpdir, 'analysis')
+            writer = analysis.AnalysisWriter(analysis_file)
+            writer.write(epd, plies)
+            writer.write(epd, [])
+            writer.close()
+            records = list(analysis.read_analyses(analysis_file))
+        self.assertEqual([(record_epd, len(record_plies)) for record_epd, record_plies in records], [(epd, 2), (epd, 0)])
+        for stored, ply in zip(records[0][1], plies):
+            for stored_array, array in zip(stored, ply):
+                self.assertTrue(np.array_equal(stored_array, array))
+
+        (_, puzzle), (_, no_puzzle) = puzzler.rescore_puzzles(records, None, 400, 100, 1.5, 0, False)
+        self.assertIsNone(no_puzzle)
+        self.assertTrue(puzzle.startswith(epd.strip() + ';bm e2e4;eval 500;'))
+        self.assertIn(';type winning;pv e2e4\n', puzzle)
+        # a higher unclear threshold turns the second ply into a puzzle as well, but the line ends with the stored analysis
+        (_, puzzle), _ = puzzler.rescore_puzzles(records, None, 400, 300, 1.5, 0, False)
+        self.assertIn(';pv e2e4,e7e5,e2e4\n', puzzle)
+
+
+class TestEpdReader(unittest.TestCase):
+    def test_selection(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epd_files = [os.path.join(tmpdir, name) for name in ('a.epd', 'b.epd')]
+            with open(epd_files[0], 'w') as f:
+                f.writelines('a{}\n'.format(i) for i in range(10))
+            with open(epd_files[1], 'w') as f:
+                f.write(''.join('b{}\n'.format(i) for i in range(7)) + 'b7')
+            lines = list(epdfile.EpdReader(epd_files))
+            self.assertEqual(len(lines), 18)
+
+            original_step = epdfile.LineIndex.STEP
+            epdfile.LineIndex.STEP = 4
+            try:
+                self.assertEqual(list(epdfile.EpdReader(epd_files, (3, 12))), lines[3:12])
+                self.assertEqual(list(epdfile.EpdReader(epd_files, (8, None))), lines[8:])
+                self.assertTrue(os.path.exists(epd_files[0] + '.idx'))
+                shards = [list(epdfile.EpdReader(epd_files, None, (i, 3))) for i in range(3)]
+                self.assertEqual([len(shard) for shard in shards], [6, 6, 6])
+                self.assertEqual(sum(shards, []), lines)
+                self.assertEqual(list(epdfile.EpdReader(epd_files, (2, 15), (1, 2))), lines[8:15])
+
+                reader = epdfile.EpdReader(epd_files, (3, 12))
+                for _, _ in zip(range(8), reader):
+                    pass
+                resumed = epdfile.EpdReader(epd_files, (3, 12))
+                resumed.seek(reader.position)
+                self.assertEqual(list(resumed), lines[11:12])
+                self.assertEqual(resumed.total - resumed.initial, len(lines[11]))
+            finally:
+                epdfile.LineIndex.STEP = original_step
+
+
+class TestEpdRecord(unittest.TestCase):
+    def test_record(self):
+        line = '8/8/8/8/8/8/8/k6K w - - 0 1;variant chess;cp 120;pv h1g1,a1b1;cp 150\n'
+        record = epdfile.EpdRecord(line)
+        self.assertEqual(record.fen, '8/8/8/8/8/8/8/k6K w - - 0 1')
+        self.assertEqual(record['variant'], 'chess')
+        self.assertEqual(record.number('cp'), 150)
+        self.assertEqual(record.number('mate'), 0)
+        self.assertNotIn('mate', record)
+        self.assertEqual(record.moves(), ['h1g1', 'a1b1'])
+        self.assertEqual(str(record), line)
+
+        record['cp'] = 200
+        self.assertEqual(record.number('cp'), 200)
+        self.assertEqual(str(record), '8/8/8/8/8/8/8/k6K w - - 0 1;variant chess;cp 200;pv h1g1,a1b1\n')
+        self.assertEqual(epdfile.EpdRecord('8/8/8/8/8/8/8/k6K w - - 0 1\n').moves(), [])
+        record = epdfile.EpdRecord('8/8/8/8/8/8/8/k6K w - - 0 1 ; variant shogi;cp 120 ; pv h1g1 \n')
+        self.assertEqual((record.fen, record['variant'], record.number('cp'), record.moves()), ('8/8/8/8/8/8/8/k6K w - - 0 1', 'shogi', 120, ['h1g1']))
+        self.assertEqual(record.annotations(), {'variant': 'shogi', 'cp': '120', 'pv': 'h1g1'})
+
+
+class TestFilter(unittest.TestCase):
+    def test_compile_filter(self):
+        calls = Counter()
+
+        def inferred(key, value):
+            def annotation(record):
+                calls[key] += 1
+                return value(record)
+            return annotation
+        inferred_annotations = {
+            'material': inferred('material', lambda record: 3),
+            'finalmaterial': inferred('finalmaterial', lambda record: 5),
+            'materialdiff': inferred('materialdiff', lambda record: record.number('finalmaterial') - record.number('material')),
+        }
+        is_filtered = filter.compile_filter({'materialdiff': '2', 'pv': '2'}, {'cp': '100'}, {'type': 'mate,winning'}, inferred_annotations)
+        line = '8/8/8/8/8/8/8/k6K w - - 0 1;cp {};type {};pv h1g1,a1b1;material 0\n'
+        self.assertFalse(is_filtered(filter.InferredRecord(line.format(50, 'mate'), inferred_annotations)))
+        self.assertEqual(calls, {'material': 1, 'finalmaterial': 1, 'materialdiff': 1})
+        calls.clear()
+        # cheap checks of the line come first
+        self.assertTrue(is_filtered(filter.InferredRecord(line.format(150, 'mate'), inferred_annotations)))
+        self.assertTrue(is_filtered(filter.InferredRecord(line.format(50, 'draw'), inferred_annotations)))
+        self.assertEqual(calls, {})
+        self.assertTrue(filter.compile_filter({'material': '4'}, {}, {}, inferred_annotations)(filter.InferredRecord(line.format(50, 'mate'), inferred_annotations)))
+
+    def test_parallel(self):
+        lines = ['8/8/8/8/8/8/8/k6K w - - 0 1;cp {};pv {}\n'.format(i, ','.join(['h1g1', 'g1h1'] * (i % 3))) for i in range(20)]
+        expected = StringIO()
+        filter.filter_puzzles(lines, expected, {'pv': '2'}, {'cp': '15'}, {}, filter.material_annotations({}))
+        self.assertEqual(expected.getvalue(), ''.join(line for i, line in enumerate(lines) if i % 3 and i <= 15))
+        output = StringIO()
+        filter.filter_puzzles_parallel(lines, output, {'pv': '2'}, {'cp': '15'}, {}, {}, 2, chunk_size=3)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+
 if __name__ == '__main__':
     unittest.main()
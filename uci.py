@@ -1,14 +1,79 @@
+import asyncio
+from contextlib import contextmanager
 import subprocess
 import threading
-from collections.abc import Iterable
+import time
 from collections import defaultdict
 
 
+INFO_FIELDS = ('depth', 'seldepth', 'multipv', 'nodes', 'nps', 'time', 'score', 'pv')
+SCORE_BOUNDS = (['lowerbound'], ['upperbound'])
+
+
+def is_score_info(line):
+    return line.startswith('info ') and ' score ' in line and not line.startswith('info string')
+
+
+def parse_info(line, fields=INFO_FIELDS):
+    """
+    Parse the given fields of a UCI info line. Missing fields are skipped.
+    Fields are looked up by token instead of tokenizing the whole line into key/value pairs.
+    The pv is expected to be the last field of the line, like in all Stockfish derivatives.
+    """
+    items = line.split()
+    info = {}
+    for key in fields:
+        try:
+            i = items.index(key, 1)
+        except ValueError:
+            continue
+        if key == 'pv':
+            info[key] = items[i + 1:]
+        elif key == 'score':
+            info[key] = items[i + 1:i + 4] if items[i + 3:i + 4] in SCORE_BOUNDS else items[i + 1:i + 3]
+        else:
+            info[key] = int(items[i + 1])
+    return info
+
+
+def parse_search(lines, fields=None, history=True):
+    """
+    Return the best move and the infos per depth and multipv line from the output of a search.
+    Only the given info fields are parsed (depth and multipv always are),
+    and without history only the infos of the final depth are kept.
+    """
+    fields = INFO_FIELDS if fields is None else ('depth', 'multipv') + tuple(f for f in fields if f not in ('depth', 'multipv'))
+    bestmove = None
+    infos = defaultdict(dict)
+    last_depth = None
+
+    for line in lines:
+        if line.startswith('bestmove'):
+            bestmove = line.split()[1]
+        elif is_score_info(line):
+            info = parse_info(line, fields)
+            depth = info.get('depth')
+            if not history and depth != last_depth:
+                infos.clear()
+                last_depth = depth
+            infos[depth][info.get('multipv', 1)] = info
+    infos = [[infos[d][m] for m in sorted(infos[d].keys())] for d in sorted(infos.keys())]
+    return bestmove, infos
+
+
+class EngineError(Exception):
+    pass
+
+
 class Engine():
     def __init__(self, args, options=None):
+        self.args = args
         self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
         self.lock = threading.Lock()
-        self.options = options or {}
+        self.options = dict(options or {})
+        self.id = ' '.join(args)
+        # optional Counter to record the time spent waiting for and parsing search output in
+        self.stats = None
         self._init()
 
     def __del__(self):
@@ -21,58 +86,86 @@ class Engine():
 
     def write(self, message):
         with self.lock:
-            self.process.stdin.write(message)
-            self.process.stdin.flush()
+            try:
+                self.process.stdin.write(message)
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError) as e:
+                raise EngineError('Engine terminated with exit code {}'.format(self.process.poll())) from e
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    def close(self, timeout=2):
+        """Quit the engine, kill it if it does not exit within timeout seconds, and close its pipes."""
+        try:
+            self.write('quit\n')
+            self.process.wait(timeout)
+        except (EngineError, subprocess.TimeoutExpired):
+            self.kill()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                # unwritten input of a dead engine, the pipe is closed anyway
+                pass
+
+    def restart(self):
+        """Replace the engine process by a new one with the same options."""
+        if self.process.poll() is None:
+            self.kill()
+        self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        self._init()
 
     def setoption(self, name, value):
+        self.options[name] = value
         self.write('setoption name {} value {}\n'.format(name, value))
 
     def _init(self):
         self.write('uci\n')
-        self.read('uciok')
-        for option, value in self.options.items():
+        for line in self.read('uciok'):
+            if line.startswith('id name '):
+                self.id = line[len('id name '):].strip()
+        for option, value in list(self.options.items()):
             self.setoption(option, value)
 
     def newgame(self):
         self.write('ucinewgame\n')
-        self.write('isready\n')
-        self.read('readyok')
+        self.isready()
+
+    def isready(self, timeout=None):
+        """Wait until the engine is ready. If it does not respond within timeout seconds, it is killed."""
+        timer = threading.Timer(timeout, self.process.kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            self.write('isready\n')
+            self.read('readyok')
+        finally:
+            if timer:
+                timer.cancel()
 
     def position(self, fen=None, moves=None):
         sfen = 'fen {}'.format(fen) if fen else 'startpos'
         moves = 'moves {}'.format(' '.join(moves)) if moves else ''
         self.write('position {} {}\n'.format(sfen, moves))
 
-    def go(self, **limits):
+    def go(self, *, fields=None, history=True, **limits):
+        """Search with the given limits and return the best move and the infos, see parse_search."""
         self.write('go {}\n'.format(' '.join(str(item) for key_value in limits.items() for item in key_value)))
-        bestmove = None
-        infos = defaultdict(dict)
-        KEYWORDS = {'depth': int, 'seldepth': int, 'multipv': int, 'nodes': int,
-                    'nps': int, 'time': int, 'score': list, 'pv': list}
-
-        for line in self.read('bestmove'):
-            items = line.split()
-            if not items:
-                continue
-            elif items[0] == 'bestmove':
-                bestmove = items[1]
-            elif items[0] == 'info' and len(items) > 1 and items[1] != 'string' and 'score' in items:
-                key = None
-                values = []
-                info = {}
-                for i in items[1:] + ['']:
-                    if not i or i in KEYWORDS:
-                        if key:
-                            if values and not issubclass(KEYWORDS[key], Iterable):
-                                values = values[0]
-                            info[key] = KEYWORDS[key](values)
-                        key = i
-                        values = []
-                    else:
-                        values.append(i)
-                infos[info.get('depth')][info.get('multipv', 1)] = info
-        infos = [[infos[d][m] for m in sorted(infos[d].keys())] for d in sorted(infos.keys())]
-        return bestmove, infos
+        if self.stats is None:
+            return parse_search(self.read('bestmove'), fields, history)
+        # engine time includes the pipe I/O of reading the output
+        start, start_cpu = time.perf_counter(), time.process_time()
+        lines = self.read('bestmove')
+        read, read_cpu = time.perf_counter(), time.process_time()
+        result = parse_search(lines, fields, history)
+        self.stats['engine_time'] += read - start
+        self.stats['engine_cpu'] += read_cpu - start_cpu
+        self.stats['parse_time'] += time.perf_counter() - read
+        self.stats['parse_cpu'] += time.process_time() - read_cpu
+        self.stats['info_lines'] += len(lines)
+        return result
 
     def stop(self):
         self.write('stop\n')
@@ -82,13 +175,224 @@ class Engine():
         while True:
             line = self.process.stdout.readline()
             if not line and self.process.poll() is not None:
-                break
+                raise EngineError('Engine terminated with exit code {}'.format(self.process.poll()))
             output.append(line)
             if line.startswith(keyword):
                 break
         return output
 
 
+class EnginePool():
+    """
+    Keeps engines warm across tasks to avoid paying the process start, handshake and network loading repeatedly.
+    Engines are grouped by arguments and options, including the variant. They are health checked on checkout,
+    and dead or unresponsive engines are replaced by new ones. Returned engines are grouped by their current options,
+    so that an engine whose options were changed with setoption is only reused for these options.
+    """
+
+    def __init__(self, health_timeout=10):
+        self.health_timeout = health_timeout
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(args, options=None, variant=None):
+        options = dict(options or {})
+        if variant:
+            options['UCI_Variant'] = variant
+        return tuple(args), tuple(sorted((name, str(value)) for name, value in options.items()))
+
+    def is_healthy(self, engine):
+        if engine.process.poll() is not None:
+            return False
+        try:
+            engine.isready(self.health_timeout)
+        except EngineError:
+            return False
+        return True
+
+    def checkout(self, args, options=None, variant=None):
+        key = self.key(args, options, variant)
+        while True:
+            with self.lock:
+                engine = self.idle[key].pop() if self.idle[key] else None
+            if engine is None:
+                engine = Engine(args, options)
+                if variant:
+                    engine.setoption('UCI_Variant', variant)
+                break
+            if self.is_healthy(engine):
+                break
+            engine.close(timeout=0)
+        return engine
+
+    def checkin(self, engine):
+        key = self.key(engine.args, engine.options)
+        with self.lock:
+            self.idle[key].append(engine)
+
+    @contextmanager
+    def engine(self, args, options=None, variant=None):
+        engine = self.checkout(args, options, variant)
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+    def close(self):
+        with self.lock:
+            engines = [engine for engines in self.idle.values() for engine in engines]
+            self.idle.clear()
+        for engine in engines:
+            engine.close()
+
+
+class AsyncEngine():
+    """
+    asyncio counterpart of Engine, so that a single thread can drive many engines.
+    Create instances using `await AsyncEngine.create(args, options)`.
+    Commands waiting for engine output are serialized per engine.
+    Cancelling a running go() stops the search and waits for its best move,
+    so that the engine is ready for the next command.
+    """
+
+    def __init__(self, args, options=None):
+        self.args = args
+        self.process = None
+        self.lock = asyncio.Lock()
+        self.options = dict(options or {})
+        self.id = ' '.join(args)
+
+    @classmethod
+    async def create(cls, args, options=None):
+        engine = cls(args, options)
+        await engine.start()
+        return engine
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(*self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        async with self.lock:
+            await self.write('uci\n')
+            for line in await self.read('uciok'):
+                if line.startswith('id name '):
+                    self.id = line[len('id name '):].strip()
+        for option, value in list(self.options.items()):
+            await self.setoption(option, value)
+
+    async def restart(self):
+        """Replace the engine process by a new one with the same options."""
+        if self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        await self.start()
+
+    async def quit(self):
+        try:
+            await self.write('quit\n')
+            await asyncio.wait_for(self.process.wait(), 2)
+        except (EngineError, asyncio.TimeoutError):
+            self.process.kill()
+            await self.process.wait()
+
+    async def write(self, message):
+        try:
+            self.process.stdin.write(message.encode())
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise EngineError('Engine terminated with exit code {}'.format(self.process.returncode)) from e
+
+    async def read(self, keyword):
+        output = []
+        while True:
+            line = (await self.process.stdout.readline()).decode()
+            if not line:
+                await self.process.wait()
+                raise EngineError('Engine terminated with exit code {}'.format(self.process.returncode))
+            output.append(line)
+            if line.startswith(keyword):
+                return output
+
+    async def setoption(self, name, value):
+        self.options[name] = value
+        await self.write('setoption name {} value {}\n'.format(name, value))
+
+    async def newgame(self):
+        async with self.lock:
+            await self.write('ucinewgame\n')
+            await self.write('isready\n')
+            await self.read('readyok')
+
+    async def position(self, fen=None, moves=None):
+        sfen = 'fen {}'.format(fen) if fen else 'startpos'
+        moves = 'moves {}'.format(' '.join(moves)) if moves else ''
+        await self.write('position {} {}\n'.format(sfen, moves))
+
+    async def go(self, *, fields=None, history=True, **limits):
+        """Search with the given limits and return the best move and the infos, see parse_search."""
+        async with self.lock:
+            await self.write('go {}\n'.format(' '.join(str(item) for key_value in limits.items() for item in key_value)))
+            try:
+                lines = await self.read('bestmove')
+            except asyncio.CancelledError:
+                await self.write('stop\n')
+                await self.read('bestmove')
+                raise
+        return parse_search(lines, fields, history)
+
+    async def stop(self):
+        await self.write('stop\n')
+
+
+class Watchdog():
+    """
+    Stops the search of an engine once a deadline has passed, and kills the engine
+    if it does not react to the stop command within kill_timeout seconds.
+    The monitoring thread sleeps on a condition variable while no deadline is pending.
+    """
+
+    def __init__(self, engine, timeout, kill_timeout=10):
+        self.engine = engine
+        self.timeout = timeout
+        self.kill_timeout = kill_timeout
+        self.condition = threading.Condition()
+        self.deadline = None
+        self.timed_out = False
+        self.killed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def start(self):
+        with self.condition:
+            self.timed_out = False
+            self.killed = False
+            self.deadline = time.monotonic() + self.timeout
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.deadline = None
+            self.condition.notify()
+
+    def _run(self):
+        with self.condition:
+            while True:
+                if self.deadline is None:
+                    self.condition.wait()
+                elif time.monotonic() < self.deadline:
+                    self.condition.wait(self.deadline - time.monotonic())
+                elif not self.timed_out:
+                    self.timed_out = True
+                    self.deadline = time.monotonic() + self.kill_timeout
+                    try:
+                        self.engine.stop()
+                    except EngineError:
+                        pass
+                else:
+                    self.killed = True
+                    self.deadline = None
+                    self.engine.process.kill()
+
+
 if __name__ == '__main__':
     import sys
     e = Engine(sys.argv[1:])